@@ -1,12 +1,21 @@
 import os
 import sys
+import glob
+import json
+import shutil
+import threading
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 import rasterio
-from rasterio.merge import merge
-from rasterio.mask import mask
-from rasterio.plot import show
+import shapely
+from affine import Affine
+from rasterio.features import geometry_mask
+from rasterio.shutil import copy as raster_copy
+from rasterio.windows import Window, transform as window_transform, bounds as window_bounds
 from shapely.geometry import Polygon
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 Purpose: to merge some Dynamic World rasters and created one output
@@ -14,18 +23,356 @@ Author : Rhorom Priyatikanto, rp1y21@soton.ac.uk
 '''
 
 def usage():
-    print('python dworld_wrapper.py -y year -b band(s)')
+    print('python dworld_wrapper.py -y year(s) -b band(s)')
     print('                         -c shp_or_bounds(xmin,xmax,ymin,ymax)')
     print('                         -o filename')
-    
-def extraction(year, indexes, region, out_file):
-    rasterdir = "Z:/Projects/WP000010_Covariates/Working/DynamicWorld/"
-    tiles = gpd.read_file(rasterdir + 'index.shp')
+    print('                         -a (all features of the shapefile) -n name_column')
+    print('                         --cache directory --cache-size GB')
+    print('                         -t threads (default: 4)')
+    print('                         -f format: bands (default), bits, classes')
+    print('                         -r resolution (multiple of the tile resolution)')
+    print('python dworld_wrapper.py -y year(s) -z zones [--layer name] -n id_column')
+    print('                         -o table.csv [-b band(s)]')
+    print('')
+    print('The tiles and the tile index are copied to the cache directory')
+    print('(or DWORLD_CACHE) and reused as long as they are unchanged on')
+    print('the drive. The least recently used tiles are removed above')
+    print('the cache size (default: 20 GB).')
+    print('')
+    print('Several years (2016,2018 or 2016-2021) and/or all the features of the')
+    print('shapefile (-a) are extracted in one pass, each tile is read once. The')
+    print('output filename can contain {region} and {year}, otherwise they are')
+    print('appended to it. The regions are named after the name column (-n) or')
+    print('their row number.')
+    print('')
+    print('Output formats: bands writes one byte band per class as the tiles.')
+    print('bits writes one 1-bit band per class (0 outside the region), classes')
+    print('writes one band with the class number (1-9, 0 for other classes, 255')
+    print('outside the region). Both are compressed Cloud-Optimized GeoTIFFs')
+    print('with overviews.')
+    print('')
+    print('With -r, every output pixel aggregates the pixels of the tiles within')
+    print('it: bands are the fractions of the classes (-1 outside the region),')
+    print('classes is the majority class.')
+    print('')
+    print('With -z, the fraction of the pixels of every zone (shapefile or')
+    print('GeoPackage layer) in each class is computed from the tiles and saved')
+    print('as a table, without writing any raster. All the bands are used')
+    print('unless -b is given.')
+
+rasterdir = "Z:/Projects/WP000010_Covariates/Working/DynamicWorld/"
+cachedir = os.environ.get('DWORLD_CACHE')
+cache_size = 20
+
+def cached_file(fname):
+    # Local copy of a file of the drive (rasterdir) in the cache directory.
+    # The copy is valid while the size and the modification time of the
+    # file on the drive are unchanged (kept in a .src file). The time
+    # of the .src file is the last use of the copy.
+    src = rasterdir + fname
+    if not(cachedir):
+        return src
+    dst = os.path.join(cachedir, fname)
+    stat = os.stat(src)
+    sig = [stat.st_size, stat.st_mtime]
+    if os.path.isfile(dst) and os.path.isfile(dst + '.src'):
+        with open(dst + '.src', 'r') as f:
+            if json.load(f) == sig:
+                os.utime(dst + '.src')
+                return dst
+
+    print('Copying %s to cache'%fname)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copyfile(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+    with open(dst + '.src', 'w') as f:
+        json.dump(sig, f)
+    return dst
+
+def evict_cache(keep=[]):
+    # Removing the least recently used files above cache_size (GB),
+    # except the files in use (keep)
+    if not(cachedir) or not(os.path.isdir(cachedir)):
+        return
+    entries = []
+    for root, _, files in os.walk(cachedir):
+        for f in files:
+            path = os.path.join(root, f)
+            if f.endswith('.src') and os.path.isfile(path[:-4]):
+                entries.append((os.path.getmtime(path), os.path.getsize(path[:-4]), path[:-4]))
+    total = 0
+    keep = [os.path.abspath(k) for k in keep]
+    for _, size, path in sorted(entries, reverse=True):
+        total += size
+        if (total > cache_size*2**30) and not(os.path.abspath(path) in keep):
+            print('Removing %s from cache'%os.path.relpath(path, cachedir))
+            os.remove(path)
+            os.remove(path + '.src')
+
+def read_index():
+    # Tile index, with all the files of the shapefile taken from the cache
+    files = [os.path.basename(f) for f in glob.glob(rasterdir + 'index.*')]
+    paths = [cached_file(f) for f in files]
+    return gpd.read_file([p for p in paths if p.endswith('.shp')][0]), paths
+
+def aggregation_factor(src, res=None):
+    # Number of pixels of the tiles (per axis) in a pixel of the output
+    # at the resolution res (a multiple of the resolution of the tiles)
+    if res is None:
+        return 1
+    factor = int(round(res/src.res[0]))
+    if (factor < 1) or (abs(factor*src.res[0] - res) > 1e-3*res):
+        print('The output resolution should be a multiple of %g'%src.res[0])
+        sys.exit(1)
+    return factor
+
+def output_grid(srcs, shapes, factor=1):
+    # Grid of the output: the pixels of the tiles (the first tile is the
+    # reference) covering the bounds of the clipping region, limited to
+    # the extent of the tiles. The tiles share the same pixel grid.
+    # With factor > 1, the output pixels are made of factor x factor
+    # pixels of the tiles, aligned from (-180, 90).
+    ref = srcs[0].transform
+    tb = np.array([src.bounds for src in srcs])
+    xmin, ymin, xmax, ymax = shapely.total_bounds(shapes)
+    xmin, ymin = max(xmin, tb[:,0].min()), max(ymin, tb[:,1].min())
+    xmax, ymax = min(xmax, tb[:,2].max()), min(ymax, tb[:,3].max())
+
+    col0 = int(np.floor((xmin - ref.c)/ref.a + 1e-6))
+    col1 = int(np.ceil((xmax - ref.c)/ref.a - 1e-6))
+    row0 = int(np.floor((ymax - ref.f)/ref.e + 1e-6))
+    row1 = int(np.ceil((ymin - ref.f)/ref.e - 1e-6))
+    if factor > 1:
+        gc, gr = int(round((ref.c + 180)/ref.a)), int(round((ref.f - 90)/ref.e))
+        col0, col1 = (gc + col0)//factor*factor - gc, -(-(gc + col1)//factor)*factor - gc
+        row0, row1 = (gr + row0)//factor*factor - gr, -(-(gr + row1)//factor)*factor - gr
+    return (ref*Affine.translation(col0, row0)*Affine.scale(factor),
+            (col1 - col0)//factor, (row1 - row0)//factor)
+
+def tile_grid(src, transform):
+    # Grid of the tiles with the origin of the output (transform)
+    return Affine(src.transform.a, 0, transform.c, 0, src.transform.e, transform.f)
+
+local = threading.local()
+opened = []
+opened_lock = threading.Lock()
+
+def open_tile(path):
+    # Datasets cannot be shared between threads, every thread
+    # keeps its own handle of each tile. The handles of all the
+    # threads are registered (opened) to be closed by close_tiles.
+    if not(hasattr(local, 'tiles')):
+        local.tiles = {}
+        with opened_lock:
+            opened.append(local.tiles)
+    if not(path in local.tiles):
+        src = rasterio.open(path, 'r')
+        with opened_lock:
+            local.tiles[path] = src
+    return local.tiles[path]
+
+def close_tiles():
+    # Closing the handles opened by every thread (main and pool threads),
+    # before their files can be evicted from the cache
+    with opened_lock:
+        for tiles in opened:
+            for src in tiles.values():
+                src.close()
+            tiles.clear()
+
+def tile_offset(src, transform):
+    # Position (row, col) of the tile origin in the output grid
+    return (int(round((src.transform.f - transform.f)/transform.e)),
+            int(round((src.transform.c - transform.c)/transform.a)))
+
+def output_meta(src, indexes, transform, width, height, block_size=512, fmt='bands', factor=1):
+    # Profile of the output (tiled GeoTIFF) and its nodata value.
+    # fmt: bands (as the tiles), bits (1-bit bands), classes (class number)
+    # With factor > 1, bands are the fractions of the classes (float)
+    out_meta = src.meta.copy()
+    nodata = out_meta['nodata'] if (out_meta['nodata'] is not None) else 0
+    out_meta.update({"driver": "GTiff",
+                     "height": height,
+                     "width": width,
+                     "count": len(indexes),
+                     "transform": transform,
+                     "crs": "EPSG:4326",
+                     "tiled": True,
+                     "blockxsize": block_size,
+                     "blockysize": block_size
+                    })
+    if fmt == 'bits':
+        out_meta.update({"dtype": "uint8", "nodata": None, "nbits": 1})
+        nodata = 0
+    elif fmt == 'classes':
+        out_meta.update({"dtype": "uint8", "nodata": 255, "count": 1})
+        nodata = 255
+    elif factor > 1:
+        out_meta.update({"dtype": "float32", "nodata": -1})
+        nodata = -1
+    return out_meta, nodata
+
+def coarse_block(block_size, factor):
+    # Block size of an output made of factor x factor pixels of the tiles,
+    # so that a block reads about block_size x block_size pixels of the
+    # tiles (multiple of 16, as required for tiled GeoTIFF)
+    if factor < 2:
+        return block_size
+    return max(16, block_size//factor//16*16)
 
-    if type(region) == list:
-        idx = tiles.geometry.intersects(region[0], align=False)
+def encode(values, inside, indexes, dtype, nodata=0, fmt='bands'):
+    # Output pixels from the selected classes (values: boolean array,
+    # one layer per class) and the pixels inside the region
+    if fmt == 'classes':
+        code = np.where(values.any(axis=0), np.asarray(indexes)[values.argmax(axis=0)], 0)
+        return np.where(inside, code, nodata).astype('uint8')[None]
+    if fmt == 'bits':
+        dtype = 'uint8'
+    return np.where(inside, values, nodata).astype(dtype)
+
+def aggregate(values, inside, indexes, factor, nodata=-1, fmt='bands'):
+    # Output pixels made of factor x factor pixels of the tiles: the
+    # fraction of the pixels inside the region in each selected class
+    # (bands) or the majority class (classes, 0 for the other classes).
+    # Pixels without any pixel inside the region are set to nodata.
+    nb, h, w = values.shape
+    h, w = h//factor, w//factor
+    n = inside.reshape(h, factor, w, factor).sum(axis=(1,3))
+    counts = values.reshape(nb, h, factor, w, factor).sum(axis=(2,4))
+    if fmt == 'classes':
+        counts = np.concatenate([(n - counts.sum(axis=0))[None], counts])
+        code = np.concatenate([[0], indexes])[counts.argmax(axis=0)]
+        return np.where(n > 0, code, nodata).astype('uint8')[None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = counts/n
+    return np.where(n > 0, frac, nodata).astype('float32')
+
+def write_path(out_file, fmt='bands'):
+    # The Cloud-Optimized GeoTIFF can only be copied from a complete
+    # raster, the blocks are written to a temporary file first
+    if fmt == 'bands':
+        return out_file
+    return out_file + '.tmp.tif'
+
+def finish_output(out_file, fmt='bands', block_size=512):
+    # Compressed Cloud-Optimized GeoTIFF with overviews
+    if fmt == 'bands':
+        return
+    tmp = write_path(out_file, fmt)
+    opts = {'COMPRESS':'DEFLATE', 'BLOCKSIZE':block_size, 'OVERVIEWS':'AUTO'}
+    if fmt == 'bits':
+        opts.update({'NBITS':1, 'RESAMPLING':'NEAREST'})
     else:
-        idx = tiles.geometry.intersects(region, align=False)
+        opts.update({'RESAMPLING':'MODE'})
+    raster_copy(tmp, out_file, driver='COG', **opts)
+    os.remove(tmp)
+
+OUTSIDE, BOUNDARY, INSIDE = 0, 1, 2
+
+def window_states(region, wins, transform):
+    # Position of every window relative to the (prepared) region:
+    # OUTSIDE, BOUNDARY or INSIDE. Only the boundary windows need
+    # to be rasterized (see window_mask).
+    if len(wins) < 1:
+        return np.zeros(0, dtype=int)
+    shapely.prepare(region)
+    b = np.array([window_bounds(win, transform) for win in wins])
+    boxes = shapely.box(b[:,0], b[:,1], b[:,2], b[:,3])
+    inside = shapely.contains(region, boxes)
+    touch = shapely.intersects(region, boxes)
+    return np.where(inside, INSIDE, np.where(touch, BOUNDARY, OUTSIDE))
+
+def window_mask(region, win, transform, state=BOUNDARY):
+    # Pixels of the window (centres) inside the region. For boundary
+    # windows, only the part of the region within the window is rasterized.
+    shape = (int(win.height), int(win.width))
+    if state == INSIDE:
+        return np.ones(shape, dtype=bool)
+    if state == OUTSIDE:
+        return np.zeros(shape, dtype=bool)
+    part = shapely.clip_by_rect(region, *window_bounds(win, transform))
+    if shapely.is_empty(part):
+        return np.zeros(shape, dtype=bool)
+    return ~geometry_mask([part], shape, window_transform(win, transform))
+
+def read_block(paths, offsets, indexes, win, transform, region, state):
+    # Window of the grid of the tiles (transform). Only the intersecting
+    # window of each tile is read; the first tile is used where tiles
+    # overlap. Returns the selected classes (boolean, one layer per class)
+    # and the pixels inside the clipping region covered by the tiles.
+    # state: position of the window relative to the region (see window_states).
+    data = np.zeros((len(indexes), win.height, win.width), dtype=bool)
+    filled = np.zeros((win.height, win.width), dtype=bool)
+    inside = window_mask(region, win, transform, state)
+
+    if inside.any():
+        for path,(r0,c0) in zip(paths, offsets):
+            src = open_tile(path)
+            top, bottom = max(win.row_off, r0), min(win.row_off + win.height, r0 + src.height)
+            left, right = max(win.col_off, c0), min(win.col_off + win.width, c0 + src.width)
+            if (top >= bottom) or (left >= right):
+                continue
+            sub = (slice(top - win.row_off, bottom - win.row_off),
+                   slice(left - win.col_off, right - win.col_off))
+            new = ~filled[sub] & inside[sub]
+            if not(new.any()):
+                continue
+            arr = src.read(indexes, window=Window(left - c0, top - r0, right - left, bottom - top))
+            data[(slice(None),) + sub][:,new] = (arr[:,new] != 0)
+            filled[sub] |= new
+    return data, filled
+
+def extract_block(paths, offsets, indexes, win, transform, region, state, dtype, nodata=0, fmt='bands', factor=1):
+    # One block (window) of the output. transform is the grid of the
+    # tiles at the origin of the output (see tile_grid), read over the
+    # factor x factor pixels of every output pixel.
+    # Pixels outside the clipping region (or not covered by the tiles)
+    # are set to nodata, the others to 1 for the selected classes, or
+    # aggregated (see aggregate).
+    # This function runs in the threads of the pool (see write_blocks).
+    if factor > 1:
+        win = Window(win.col_off*factor, win.row_off*factor, win.width*factor, win.height*factor)
+    data, filled = read_block(paths, offsets, indexes, win, transform, region, state)
+    if factor > 1:
+        return aggregate(data, filled, indexes, factor, nodata, fmt)
+    return encode(data, filled, indexes, dtype, nodata, fmt)
+
+def write_blocks(dest, pool, paths, offsets, indexes, transform, region, dtype, nodata=0, fmt='bands',
+                 threads=4, factor=1):
+    # The blocks of the output (dest) are read by a pool of threads (GDAL
+    # releases the GIL while reading) and written in order as they are
+    # ready. At most 2*threads blocks are kept in memory.
+    # transform: grid of the tiles at the origin of the output (see tile_grid)
+    wins = [win for _, win in dest.block_windows(1)]
+    states = window_states(region, wins, dest.transform)
+    print('Blocks inside: %d, boundary: %d, outside: %d'%(np.sum(states == INSIDE),
+          np.sum(states == BOUNDARY), np.sum(states == OUTSIDE)))
+    pending = deque()
+    done = 0
+    for k in range(len(wins) + 1):
+        if k < len(wins):
+            pending.append((wins[k], pool.submit(extract_block, paths, offsets, indexes, wins[k], transform,
+                                                 region, states[k], dtype, nodata, fmt, factor)))
+        while (len(pending) > 2*threads) or ((k == len(wins)) and (len(pending) > 0)):
+            win, job = pending.popleft()
+            dest.write(job.result(), window=win)
+            done += 1
+            if (done % max(1, len(wins)//10) == 0) or (done == len(wins)):
+                print('Written %d of %d blocks'%(done, len(wins)))
+
+def extraction(year, indexes, region, out_file, block_size=512, threads=4, fmt='bands', res=None):
+    # The output grid is computed from the bounds of the clipping region
+    # and written block by block: each block reads the intersecting
+    # windows of the tiles and is masked with the clipping region, so
+    # the memory use is bounded by the block size (see write_blocks).
+    # Where tiles overlap, the pixels of the first tile of the index are
+    # used (rasterio.merge filled the zeros of a tile from the next ones).
+    # With res, the blocks are aggregated on read to the coarser resolution.
+    shapes = region if (type(region) == list) else [region]
+    region = shapely.union_all(shapes)
+    tiles, used = read_index()
+
+    idx = tiles.geometry.intersects(region, align=False)
     suffixes = tiles[idx].ID
     ntiles = np.sum(idx)
     if ntiles < 1:
@@ -35,66 +382,324 @@ def extraction(year, indexes, region, out_file):
         
     print('')
     print('Checking %d tiles'%ntiles)
-    src_files_to_mosaic = []
+    fnames = []
     for suffix in suffixes:
         fname = '%s/dworld_%s_%s.tif'%(year, year, suffix)
         if (os.path.isfile(rasterdir + fname)):
             print(fname, 'available')
-            src = rasterio.open(rasterdir + fname, 'r')
-            src_files_to_mosaic.append(src)
+            fnames.append(fname)
         else:
             print(fname, 'not available')
 
-    ntiles = len(src_files_to_mosaic)
-
+    pool = ThreadPoolExecutor(max_workers=threads)
+    paths = list(pool.map(cached_file, fnames))
+    used += paths
+    srcs = list(pool.map(open_tile, paths))
+    ntiles = len(srcs)
     if ntiles < 1:
         print('Required tile(s) not available')
         sys.exit(1)
-    
-    if ntiles == 1:
-        mosaic = src.read(indexes)
-        out_trans = src.meta['transform']
-        print('')
-        print('Reading 1 tile')
-    else:
-        print('')
-        print('Mosaicing %s tiles'%ntiles)
-        mosaic, out_trans = merge(src_files_to_mosaic, indexes=indexes)
+    evict_cache(keep=used)
 
-    out_meta = src.meta.copy()
-    out_meta.update({"driver": "GTiff",
-                     "height": mosaic.shape[1],
-                     "width": mosaic.shape[2],
-                     "count": len(indexes),
-                     "transform": out_trans,
-                     "crs": "EPSG:4326"
-                    })
-    with rasterio.open(out_file, 'w', **out_meta) as dest:
-        dest.write(mosaic.astype('bool'))
+    factor = aggregation_factor(srcs[0], res)
+    block_size = coarse_block(block_size, factor)
+    transform, width, height = output_grid(srcs, shapes, factor)
+    if (width < 1) or (height < 1):
+        print('Clipping region does not overlap the available tile(s)')
+        sys.exit(1)
+    grid = tile_grid(srcs[0], transform)
+    offsets = [tile_offset(src, grid) for src in srcs]
+
+    out_meta, nodata = output_meta(srcs[0], indexes, transform, width, height, block_size, fmt, factor)
 
     print('')
-    print('Clipping raster')
-    with rasterio.open(out_file, 'r') as src:
-        clip, out_trans = rasterio.mask.mask(src, region, crop=True)
-        out_meta = src.meta.copy()
-    
-    out_meta.update({"height": clip.shape[1],
-                     "width": clip.shape[2],
-                     "transform": out_trans,
-                    })
-    
-    with rasterio.open(out_file, 'w', **out_meta) as dest:
-        dest.write(clip.astype('bool'))
+    print('Extracting %d tile(s) into %d x %d pixels'%(ntiles, width, height))
+    if factor > 1:
+        print('Resolution: %g (%d x %d pixels of the tiles)'%(transform.a, factor, factor))
+    with rasterio.open(write_path(out_file, fmt), 'w', **out_meta) as dest:
+        write_blocks(dest, pool, paths, offsets, indexes, grid, region, srcs[0].dtypes[0], nodata, fmt,
+                     threads, factor)
+    finish_output(out_file, fmt, block_size)
 
+    pool.shutdown()
+    close_tiles()
     print('')
     print('Extraction finished')
 
+def earlier_mask(top, left, height, width, earlier):
+    # Pixels of a window not covered by the tiles read before (earlier:
+    # (row, col, height, width) in the grid of the window), as the first
+    # tile is used where tiles overlap (see read_block). None when no
+    # pixel is covered.
+    keep = None
+    for er, ec, eh, ew in earlier:
+        t, b = max(top, er), min(top + height, er + eh)
+        l, r = max(left, ec), min(left + width, ec + ew)
+        if (t < b) and (l < r):
+            if keep is None:
+                keep = np.ones((height, width), dtype=bool)
+            keep[t-top:b-top, l-left:r-left] = False
+    return keep
+
+def strip_cuts(src, strips, nrows, part):
+    # Windows of an output (part: key, transform, (row, col) of the tile
+    # in the output grid, (height, width) of the output, region, (row,
+    # col, height, width) of the tiles read before it in the output grid)
+    # covered by the strips of rows of a tile, with their position
+    # relative to the region (see window_states) and the parts of the
+    # window already covered by the earlier tiles (the first tile is used
+    # where tiles overlap, as in read_block). None for the strips not
+    # touching the region or entirely covered by earlier tiles.
+    key, transform, (r0,c0), (h,w), region, earlier = part
+    cuts = [None]*len(strips)
+    covers = [None]*len(strips)
+    for j,row0 in enumerate(strips):
+        top, bottom = max(r0 + row0, 0), min(r0 + row0 + nrows, h, r0 + src.height)
+        left, right = max(c0, 0), min(c0 + src.width, w)
+        if (top >= bottom) or (left >= right):
+            continue
+        keep = earlier_mask(top, left, bottom - top, right - left, earlier)
+        if (keep is None) or keep.any():
+            cuts[j] = Window(left, top, right - left, bottom - top)
+            covers[j] = keep
+    sel = [j for j in range(len(strips)) if cuts[j] is not None]
+    states = window_states(region, [cuts[j] for j in sel], transform)
+    for j,state in zip(sel, states):
+        cuts[j] = None if (state == OUTSIDE) else (key, transform, cuts[j], r0, c0, region, state, covers[j])
+    return cuts
+
+def tile_strip(path, row0, nrows, indexes, cuts, dtype, nodata=0, fmt='bands'):
+    # Rows [row0, row0+nrows) of a tile, read once and cut into the
+    # windows of the outputs touching them (see strip_cuts). Only the
+    # windows containing pixels of their region are returned as
+    # (key, window, data, keep), keep being the pixels not already
+    # written from an earlier tile (None when there are none).
+    # This function runs in the threads of the pool (see batch_extraction).
+    src = open_tile(path)
+    col_min = min([cut[2].col_off - cut[4] for cut in cuts])
+    col_max = max([cut[2].col_off + cut[2].width - cut[4] for cut in cuts])
+    arr = src.read(indexes, window=Window(col_min, row0, col_max - col_min, nrows))
+
+    out = []
+    for key, transform, win, r0, c0, region, state, keep in cuts:
+        inside = window_mask(region, win, transform, state)
+        if not((inside if (keep is None) else (inside & keep)).any()):
+            continue
+        rows = slice(win.row_off - r0 - row0, win.row_off - r0 - row0 + win.height)
+        cols = slice(win.col_off - c0 - col_min, win.col_off - c0 - col_min + win.width)
+        out.append((key, win, encode(arr[:,rows,cols] != 0, inside, indexes, dtype, nodata, fmt), keep))
+    return out
+
+def batch_extraction(years, indexes, regions, out_pattern, block_size=512, threads=4, fmt='bands', res=None):
+    # Extraction of many regions ({name: geometry}) and years at once,
+    # one output per region and year (out_pattern with {region} and
+    # {year}). The tiles needed by every region are planned first, then
+    # every tile is read once, in strips of rows, and the strips are
+    # written to all the outputs they touch. An output is closed after
+    # its last tile. Where tiles overlap, the first tile is used (as in
+    # extraction): the pixels already written are read back and kept.
+    # With res, the output pixels can span several tiles: every output
+    # is aggregated block by block instead (see write_blocks).
+    tiles, used = read_index()
+    names = list(regions.keys())
+    geoms = np.array([regions[n] for n in names], dtype=object)
+    ireg, itile = shapely.STRtree(tiles.geometry.values).query(geoms, predicate='intersects')
+    pool = ThreadPoolExecutor(max_workers=threads)
+
+    for year in years:
+        fnames = {t:'%s/dworld_%s_%s.tif'%(year, year, tiles.ID.values[t]) for t in np.unique(itile)}
+        fnames = {t:f for t,f in fnames.items() if os.path.isfile(rasterdir + f)}
+        print('')
+        print('Year %s: %d of %d tiles available'%(year, len(fnames), len(np.unique(itile))))
+        paths = dict(zip(fnames.keys(), pool.map(cached_file, fnames.values())))
+        srcs = {t:open_tile(p) for t,p in paths.items()}
+        evict_cache(keep=used + list(paths.values()))
+        factor = aggregation_factor(list(srcs.values())[0], res) if (len(srcs) > 0) else 1
+        size = coarse_block(block_size, factor)
+
+        # Output grid of every region on the available tiles
+        jobs = {}
+        for r in range(len(names)):
+            ts = sorted([t for t in itile[ireg == r] if t in srcs])
+            if len(ts) < 1:
+                print('No tile available for', names[r])
+                continue
+            transform, width, height = output_grid([srcs[t] for t in ts], [geoms[r]], factor)
+            if (width > 0) and (height > 0):
+                jobs[r] = {'transform':transform, 'width':width, 'height':height, 'tiles':ts}
+
+        if factor > 1:
+            for r,job in jobs.items():
+                ts = job['tiles']
+                out_file = out_pattern.format(region=names[r], year=year)
+                grid = tile_grid(srcs[ts[0]], job['transform'])
+                out_meta, nodata = output_meta(srcs[ts[0]], indexes, job['transform'], job['width'],
+                                               job['height'], size, fmt, factor)
+                print('Aggregating %d tile(s) for %s'%(len(ts), names[r]))
+                with rasterio.open(write_path(out_file, fmt), 'w', **out_meta) as dest:
+                    write_blocks(dest, pool, [paths[t] for t in ts], [tile_offset(srcs[t], grid) for t in ts],
+                                 indexes, grid, shapely.union_all([geoms[r]]), srcs[ts[0]].dtypes[0],
+                                 nodata, fmt, threads, factor)
+                finish_output(out_file, fmt, size)
+                print('Written', out_file)
+            close_tiles()
+            continue
+
+        remaining = {r:len(job['tiles']) for r,job in jobs.items()}
+        dests = {}
+        for k,(t,src) in enumerate(srcs.items()):
+            served = [r for r in jobs if t in jobs[r]['tiles']]
+            if len(served) < 1:
+                continue
+            parts = []
+            for r in served:
+                job = jobs[r]
+                out_meta, nodata = output_meta(src, indexes, job['transform'], job['width'],
+                                               job['height'], block_size, fmt)
+                if not(r in dests):
+                    out_file = out_pattern.format(region=names[r], year=year)
+                    dests[r] = rasterio.open(write_path(out_file, fmt), 'w+', **out_meta)
+                earlier = [tile_offset(srcs[e], job['transform']) + srcs[e].shape
+                           for e in job['tiles'][:job['tiles'].index(t)]]
+                parts.append((r, job['transform'], tile_offset(src, job['transform']),
+                              (job['height'], job['width']), geoms[r], earlier))
+
+            print('Reading %s for %d region(s) (%d of %d)'%(fnames[t], len(served), k+1, len(srcs)))
+            pending = deque()
+            strips = list(range(0, src.height, block_size))
+            cuts = [strip_cuts(src, strips, block_size, part) for part in parts]
+            for j in range(len(strips) + 1):
+                cut = [c[j] for c in cuts if c[j] is not None] if (j < len(strips)) else []
+                if len(cut) > 0:
+                    nrows = min(block_size, src.height - strips[j])
+                    pending.append(pool.submit(tile_strip, paths[t], strips[j], nrows, indexes, cut,
+                                               src.dtypes[0], nodata, fmt))
+                while (len(pending) > 2*threads) or ((j == len(strips)) and (len(pending) > 0)):
+                    for r, win, data, keep in pending.popleft().result():
+                        if keep is not None:
+                            data = np.where(keep, data, dests[r].read(window=win))
+                        dests[r].write(data, window=win)
+
+            for r in served:
+                remaining[r] -= 1
+                if remaining[r] == 0:
+                    dests.pop(r).close()
+                    finish_output(out_pattern.format(region=names[r], year=year), fmt, block_size)
+                    print('Written', out_pattern.format(region=names[r], year=year))
+        close_tiles()
+
+    pool.shutdown()
+    print('')
+    print('Extraction finished')
+
+def zone_windows(src, geoms, row0, nrows):
+    # Windows of the zones (geoms) in the strip of rows [row0, row0+nrows)
+    # of a tile, as (col_off, row_off, width, height) from the bounds of
+    # the zones, and their position relative to the zones (see window_states).
+    t = src.transform
+    b = shapely.bounds(geoms)
+    col0 = np.maximum(np.floor((b[:,0] - t.c)/t.a + 1e-6), 0)
+    col1 = np.minimum(np.ceil((b[:,2] - t.c)/t.a - 1e-6), src.width)
+    top = np.maximum(np.floor((b[:,3] - t.f)/t.e + 1e-6), row0)
+    bottom = np.minimum(np.ceil((b[:,1] - t.f)/t.e - 1e-6), row0 + nrows)
+    wins = np.c_[col0, top, col1 - col0, bottom - top].astype(int)
+    ok = (wins[:,2] > 0) & (wins[:,3] > 0)
+    xmin, ymax = t*(wins[:,0], wins[:,1])
+    xmax, ymin = t*(wins[:,0] + wins[:,2], wins[:,1] + wins[:,3])
+    boxes = shapely.box(xmin, ymin, xmax, ymax)
+    states = np.where(shapely.contains(geoms, boxes), INSIDE,
+                      np.where(shapely.intersects(geoms, boxes), BOUNDARY, OUTSIDE))
+    states[~ok] = OUTSIDE
+    return wins, states
+
+def zone_strip(path, row0, nrows, indexes, zones, earlier=[]):
+    # Pixel counts of the zones in the rows [row0, row0+nrows) of a tile,
+    # read once. zones: (zone, geometry, window, state), see zone_windows.
+    # The pixels covered by the tiles read before (earlier, see
+    # earlier_mask) are left out.
+    # Returns (zone, pixels inside the zone, pixels of every class).
+    # This function runs in the threads of the pool (see zone_fractions).
+    src = open_tile(path)
+    col_min = min([w[0] for _, _, w, _ in zones])
+    col_max = max([w[0] + w[2] for _, _, w, _ in zones])
+    arr = src.read(indexes, window=Window(col_min, row0, col_max - col_min, nrows))
+
+    out = []
+    for z, geom, (col, row, width, height), state in zones:
+        inside = window_mask(geom, Window(col, row, width, height), src.transform, state)
+        keep = earlier_mask(row, col, height, width, earlier)
+        if keep is not None:
+            inside = inside & keep
+        sub = arr[:, row - row0:row - row0 + height, col - col_min:col - col_min + width][:,inside]
+        out.append((z, inside.sum(), (sub != 0).sum(axis=1)))
+    return out
+
+def zone_fractions(years, indexes, zones, ids, out_file, id_col='ID', block_size=512, threads=4):
+    # Fraction of the pixels of every zone (geometries, named by ids) in
+    # each class and year, computed from the tiles without writing any
+    # raster. Every tile is read once per year, in strips of rows, and
+    # only the columns covering the zones touching the strip. The zones
+    # may overlap. Where tiles overlap, the first tile is used (as in
+    # extraction). The table has one row per zone and the columns
+    # {band}_{year} and pixels_{year} (pixels of the zone on the tiles).
+    band_names = ['water', 'trees', 'grass', 'flooded_vegetation', 'crops', 'shrub_and_scrub',
+                  'built', 'bare', 'snow_and_ice']
+    tiles, used = read_index()
+    geoms = np.asarray(zones, dtype=object)
+    shapely.prepare(geoms)
+    izone, itile = shapely.STRtree(tiles.geometry.values).query(geoms, predicate='intersects')
+    pool = ThreadPoolExecutor(max_workers=threads)
+    table = pd.DataFrame({id_col:ids})
+
+    for year in years:
+        fnames = {t:'%s/dworld_%s_%s.tif'%(year, year, tiles.ID.values[t]) for t in np.unique(itile)}
+        fnames = {t:f for t,f in fnames.items() if os.path.isfile(rasterdir + f)}
+        print('')
+        print('Year %s: %d of %d tiles available'%(year, len(fnames), len(np.unique(itile))))
+        paths = dict(zip(fnames.keys(), pool.map(cached_file, fnames.values())))
+        evict_cache(keep=used + list(paths.values()))
+
+        npix = np.zeros(len(geoms), dtype=np.int64)
+        counts = np.zeros((len(geoms), len(indexes)), dtype=np.int64)
+        for k,(t,path) in enumerate(paths.items()):
+            src = open_tile(path)
+            earlier = [tile_offset(open_tile(paths[e]), src.transform) + open_tile(paths[e]).shape
+                       for e in paths if e < t]
+            sel = izone[itile == t]
+            print('Reading %s for %d zone(s) (%d of %d)'%(fnames[t], len(sel), k+1, len(paths)))
+            pending = deque()
+            strips = list(range(0, src.height, block_size))
+            for j in range(len(strips) + 1):
+                if j < len(strips):
+                    nrows = min(block_size, src.height - strips[j])
+                    wins, states = zone_windows(src, geoms[sel], strips[j], nrows)
+                    jobs = [(z, geoms[z], wins[m], states[m]) for m,z in enumerate(sel) if states[m] != OUTSIDE]
+                    if len(jobs) > 0:
+                        pending.append(pool.submit(zone_strip, path, strips[j], nrows, indexes, jobs,
+                                                   earlier))
+                while (len(pending) > 2*threads) or ((j == len(strips)) and (len(pending) > 0)):
+                    for z, n, c in pending.popleft().result():
+                        npix[z] += n
+                        counts[z] += c
+        close_tiles()
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = counts/npix[:,None]
+        for b,idx in enumerate(indexes):
+            table['%s_%s'%(band_names[idx-1], year)] = frac[:,b]
+        table['pixels_%s'%year] = npix
+        print('Zones without pixels: %d of %d'%(np.sum(npix == 0), len(geoms)))
+
+    pool.shutdown()
+    print('')
+    print('Saving table:', out_file)
+    table.to_csv(out_file, index=False)
+
 def main(argv=None):
+    global cachedir, cache_size
     if argv == None:
         argv = sys.argv
     
-    rasterdir = "Z:/Projects/WP000010_Covariates/Working/DynamicWorld/"
-    
     if not(os.path.exists(rasterdir)):
         print('Check your access to the WorldPop Drive')
         print("//worldpop.files.soton.ac.uk/worldpop/")
@@ -103,15 +708,28 @@ def main(argv=None):
     band_names = np.array(['water', 'trees', 'grass', 'flooded_vegetation', 'crops', 'shrub_and_scrub', 'built', 'bare', 'snow_and_ice'])
     region = []
     out_file = 'out_image.tif'
+    threads = 4
+    all_features = False
+    name_col = None
+    fmt = 'bands'
+    zone_file = None
+    layer = None
+    res = None
+    band = band_names.tolist()
+    band_idx = list(range(1, len(band_names)+1))
     i = 1
     
     while i < len(argv):
         if argv[i] == '-y':
-            year = argv[i+1]
-            if not(year in np.arange(2016,2022).astype(str)):
-                print('Rasters from year %s is not available'%year)
-                print('Available year: 2016-2021')
-                sys.exit(1)
+            years = argv[i+1].replace(' ','').split(',')
+            if (len(years) == 1) and ('-' in years[0]):
+                y0, y1 = years[0].split('-')
+                years = np.arange(int(y0), int(y1)+1).astype(str).tolist()
+            for year in years:
+                if not(year in np.arange(2016,2022).astype(str)):
+                    print('Rasters from year %s is not available'%year)
+                    print('Available year: 2016-2021')
+                    sys.exit(1)
             
         elif argv[i] == '-b':
             band = argv[i+1]
@@ -135,12 +753,10 @@ def main(argv=None):
                     sys.exit(1)
                     
                 bound = gpd.read_file(clipper)
-                if (bound._crs.srs != 'epsg:4326'):
-                    print('Transforming CRS of the clipping region: from %s to epsg:4326'%(bound._crs.srs))
+                if (bound.crs.to_epsg() != 4326):
+                    print('Transforming CRS of the clipping region: from %s to epsg:4326'%(bound.crs.srs))
                     bound = bound.to_crs(4326)
-                if len(bound) > 1:
-                    print('The first of %d clipping regions is selected'%len(bound))
-                region = bound.iloc[0].geometry
+                region = [bound.iloc[0].geometry]
                 
             else:
                 try:
@@ -155,18 +771,100 @@ def main(argv=None):
 
         elif argv[i] == '-o':
             out_file = argv[i+1]
+
+        elif argv[i] == '--cache':
+            cachedir = argv[i+1]
+
+        elif argv[i] == '--cache-size':
+            cache_size = float(argv[i+1])
+
+        elif argv[i] == '-t':
+            threads = int(argv[i+1])
+
+        elif argv[i] == '-a':
+            all_features = True
+
+        elif argv[i] == '-n':
+            name_col = argv[i+1]
+
+        elif argv[i] == '-z':
+            zone_file = argv[i+1]
+            if not(os.path.isfile(zone_file)):
+                print('Zone file is not available')
+                sys.exit(1)
+
+        elif argv[i] == '-r':
+            res = float(argv[i+1])
+
+        elif argv[i] == '--layer':
+            layer = argv[i+1]
+
+        elif argv[i] == '-f':
+            fmt = argv[i+1]
+            if not(fmt in ['bands', 'bits', 'classes']):
+                print('Output format should be bands, bits, or classes')
+                sys.exit(1)
             
         i += 1
-        
+
+    if zone_file is not None:
+        zones = gpd.read_file(zone_file, layer=layer)
+        if (zones.crs is not None) and (zones.crs.to_epsg() != 4326):
+            print('Transforming CRS of the zones: from %s to epsg:4326'%(zones.crs.srs))
+            zones = zones.to_crs(4326)
+        id_col = name_col if (name_col is not None) else 'ID'
+        ids = zones[id_col].values if (name_col is not None) else zones.index.values
+        if not(out_file.endswith('.csv')):
+            out_file = os.path.splitext(out_file)[0] + '.csv'
+        print('')
+        print('Computing Dynamic World fractions')
+        print('year(s): %s, band(s): %s, zone(s): %d, output: %s'%(','.join(years), band,
+                                                                   len(zones), out_file))
+        zone_fractions(years, band_idx, zones.geometry.values, ids, out_file, id_col, threads=threads)
+        return
+
     if len(region) < 1:
         usage()
         sys.exit(1)
+    if (res is not None) and (fmt == 'bits'):
+        print('Output format bits is not available with -r, use bands (fractions) or classes')
+        sys.exit(1)
+
+    if all_features and (clipper[-4:] == '.shp'):
+        if name_col is None:
+            names = bound.index.astype(str)
+        else:
+            names = bound[name_col].astype(str).str.replace(' ', '_').str.replace('/', '_')
+        # Repeated names are numbered (name_2, name_3...) to keep all the regions
+        regions = {}
+        for name, geom in zip(names, bound.geometry.values):
+            key, k = name, 1
+            while key in regions:
+                k += 1
+                key = '%s_%d'%(name, k)
+            if key != name:
+                print('Region name %s is repeated, saved as %s'%(name, key))
+            regions[key] = geom
+    else:
+        if (clipper[-4:] == '.shp') and (len(bound) > 1):
+            print('The first of %d clipping regions is selected'%len(bound))
+        regions = {'region':region[0]}
 
     print('')
     print('Extracting Dynamic World rasters')
-    print('year: %s, band(s): %s, output: %s'%(year, band, out_file))
-    
-    extraction(year, band_idx, region, out_file)
+    if (len(years) == 1) and (len(regions) == 1):
+        print('year: %s, band(s): %s, output: %s'%(years[0], band, out_file))
+        extraction(years[0], band_idx, region, out_file, threads=threads, fmt=fmt, res=res)
+    else:
+        stem, ext = os.path.splitext(out_file)
+        if not('{region}' in stem):
+            stem += '_{region}'
+        if not('{year}' in stem):
+            stem += '_{year}'
+        out_file = stem + (ext if ext else '.tif')
+        print('year(s): %s, band(s): %s, region(s): %d, output: %s'%(','.join(years), band,
+                                                                     len(regions), out_file))
+        batch_extraction(years, band_idx, regions, out_file, threads=threads, fmt=fmt, res=res)
     
 if __name__ == '__main__':
     sys.exit(main())
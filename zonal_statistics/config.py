@@ -4,13 +4,32 @@ year_end = 2021
 radii = [10]
 location = 'sample/points_1_edit.csv'
 raster_file = 'sample/pop_dummy.tif'
+raster_values = 'density'
 processing_mode = 'edit'
 clipped_only = True
 versioning = True
+export_csv = True
 id_col = 'LOCATION_ID'
+streaming = False
+workers = 1
+cache_size = 1024
 
 # raster_file defines the file naming format of the gridded 
 # population data used in the process. Do not replace '{year}' 
 # as this variable will be filled in get_population.py.
+# raster_values = 'density' reads the raster as people per km2
+# (population = density x covered area); 'count' reads it as
+# people per pixel (population = sum of the covered pixels).
+# The population tables are kept in out/pop_*.sqlite, export_csv
+# = True also writes them as CSV (out/pop_*.csv) after every run.
+# versioning = True records the changes of every run in the store,
+# the table of any date can be exported with pop_history.py.
+# streaming = True reads the population raster block by block.
+# Otherwise it is read in a single window covering all buffers,
+# unless that window exceeds 256 MB (then it is read by blocks too).
+# workers > 1 rasterizes the buffers with a pool of processes.
+# cache_size (MB) bounds the cache of buffer files (geom/.cache),
+# which skips the buffer creation when location, radii and
+# processing_mode are unchanged. Set it to 0 to disable the cache.
 
 ### END CONFIGURATION ###
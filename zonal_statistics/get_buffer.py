@@ -1,14 +1,16 @@
 import sys
 import os
+import shutil
+import hashlib
+import json
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import fiona
+import shapely
 
-from tqdm import tqdm
-from scipy.spatial import Voronoi
-from shapely.geometry import LineString
-from shapely.ops import polygonize, linemerge, unary_union
+from scipy import sparse
+from scipy.spatial import Delaunay, cKDTree, QhullError
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -21,30 +23,109 @@ def usage():
     print('                             be added, edited, or removed. Coordinates of')
     print('                             the points should be provided (lon-lat columns).')
     print('                             Remark column should either be add, edit, remove.')
-    print('-r, --rad                    Radius of the buffer in kilometer. Default value: 5')
+    print('-r, --rad                    Radius of the buffer in kilometer. Multiple radii')
+    print('                             can be separated by comma (e.g. 5,10), each radius')
+    print('                             is saved as a layer (e.g. 10km). Default value: 5')
     print('-o, --output                 Prefix name. Default value: output')
     print('-c, --clip                   Perform clipping to overlapping buffers. ')
+    print('-u, --unclipped              Also save the unclipped buffers when clipping.')
+    print('-n, --nvert                  Number of vertices of the circular buffers.')
+    print('                             Default value: 64')
     print('--id                         ID column name')
+    print('--cache                      Size limit (MB) of the cache of output files, kept')
+    print('                             in .cache next to the output. The buffers are not')
+    print('                             created again for the same input files and')
+    print('                             parameters. Default value: 0 (no cache)')
     print('-h, --help                   Show this message and exit.')
     print('')
     print('Example: python get_buffer.py -i sample/points_1.csv -e sample/points_1_edit.csv')
-    print('                              -r 10 -o buffer -clip')
+    print('                              -r 5,10 -o buffer -clip')
     print()
 
-def buffer_from_points(x, y, r, as_gdf=False):
-    geom = gpd.points_from_xy(x, y, crs=4326).to_crs(3857).buffer(r).to_crs(4326)
+EARTH_RADIUS = 6371007.2 # authalic radius (m)
+
+def geodesic_circles(lon, lat, r, nvert=64):
+    # Circles with radius r (metre) around the points (lon, lat), computed
+    # on the sphere for all points at once. The vertices are at the true
+    # distance r from the centre, so the circles are not distorted away
+    # from the equator. r can also be given per point. The circles
+    # (EPSG:4326) and their areas (km2) are returned.
+
+    lon = np.radians(np.asarray(lon, dtype=float))[:,None]
+    lat = np.radians(np.asarray(lat, dtype=float))[:,None]
+    d = np.reshape(np.asarray(r, dtype=float)/EARTH_RADIUS, (-1,1))
+    az = np.linspace(2*np.pi, 0, nvert, endpoint=False)[None,:]
+    lat2 = np.arcsin(np.sin(lat)*np.cos(d) + np.cos(lat)*np.sin(d)*np.cos(az))
+    lon2 = lon + np.arctan2(np.sin(az)*np.sin(d)*np.cos(lat), np.cos(d) - np.sin(lat)*np.sin(lat2))
+    lon2 = np.concatenate([lon2, lon2[:,:1]], axis=1)
+    lat2 = np.concatenate([lat2, lat2[:,:1]], axis=1)
+
+    circles = shapely.polygons(np.stack([np.degrees(lon2), np.degrees(lat2)], axis=2))
+    area = np.abs(np.sum(edge_excess(lon2[:,:-1], lat2[:,:-1], lon2[:,1:], lat2[:,1:]), axis=1))
+    return circles, 1e-6*EARTH_RADIUS**2*area
+
+def geodesic_distance(lon1, lat1, lon2, lat2):
+    # Distance (metre) on the sphere between (lon1, lat1) and (lon2, lat2),
+    # the same model as geodesic_circles (haversine formula)
+
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(v, dtype=float)) for v in [lon1, lat1, lon2, lat2]]
+    h = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def edge_excess(lon1, lat1, lon2, lat2):
+    # Signed spherical excess of the triangles formed by the pole and
+    # the great-circle edges (lon1, lat1)-(lon2, lat2), in radians.
+    # Their sum over a ring gives the area enclosed by the ring.
+    t1 = np.tan(lat1/2)
+    t2 = np.tan(lat2/2)
+    return 2*np.arctan2(np.tan((lon2 - lon1)/2)*(t1 + t2), 1 + t1*t2)
+
+def geodesic_area(geoms):
+    # Area (km2) of polygons in EPSG:4326 on the sphere, for all
+    # geometries at once. Holes are subtracted.
+
+    geoms = np.asarray(geoms)
+    parts, gidx = shapely.get_parts(geoms, return_index=True)
+    rings, pidx = shapely.get_rings(parts, return_index=True)
+    coords, ridx = shapely.get_coordinates(rings, return_index=True)
+    lon, lat = np.radians(coords[:,0]), np.radians(coords[:,1])
+
+    edge = ridx[1:] == ridx[:-1]
+    excess = edge_excess(lon[:-1][edge], lat[:-1][edge], lon[1:][edge], lat[1:][edge])
+    ring_area = np.abs(np.bincount(ridx[:-1][edge], weights=excess, minlength=len(rings)))
+    exterior = np.concatenate([[True], pidx[1:] != pidx[:-1]])
+    part_area = np.bincount(pidx, weights=np.where(exterior, ring_area, -ring_area), minlength=len(parts))
+    area = np.bincount(gidx, weights=part_area, minlength=len(geoms))
+    return 1e-6*EARTH_RADIUS**2*area
+
+def buffer_from_points(x, y, r, as_gdf=False, nvert=64):
+    geom, _ = geodesic_circles(x, y, r, nvert=nvert)
     if as_gdf:
-        geom = gpd.GeoDataFrame(geometry=geom)
+        geom = gpd.GeoDataFrame(geometry=geom, crs=4326)
     return geom
 
-def get_input(path_, rad_=5000):
+def layer_name(rad):
+    # Layer of the buffers with radius rad (kilometre)
+    return f'{rad:g}km'
+
+def with_radius(gdf_, rad_, nvert=64):
+    # Copy of the buffers with circles of radius rad_ (metre) around
+    # the same points (lon, lat)
+    gdf_ = gdf_.copy()
+    buf, area = geodesic_circles(gdf_['lon'].values, gdf_['lat'].values, rad_, nvert=nvert)
+    gdf_['geometry'] = buf
+    gdf_['area'] = area
+    return gdf_
+
+def get_input(path_, rad_=5000, nvert=64, layer=None):
     # Read input CSV or Excel containing coordinates of the locations.
     # [lat, latitude, y] can be regarded as latitude column.
     # [lon, long, longitude, x] can be regarded as longitude column.
     # The column naming is case insensitive.
     # This function produce geopandas dataframe containg circular buffers
     # as the geometry. The point location (lon, lat) is kept and the area
-    # of the buffer is added.
+    # of the buffer is added. For vector files, the layer can be selected
+    # (the first layer by default).
 
     print('Radius (m):', rad_)
     if not(os.path.isfile(path_)):
@@ -68,17 +149,18 @@ def get_input(path_, rad_=5000):
         lon = list(filter(('NA').__ne__, lon))[0]
 
         gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon], df[lat]), crs='epsg:4326')
-        buf = gdf.to_crs(3857).buffer(rad_)
+        buf, area = geodesic_circles(gdf.geometry.x, gdf.geometry.y, rad_, nvert=nvert)
         gdf = gdf.drop(columns=[lon,lat])
-        gdf['area'] = 1e-6*buf.area
+        gdf['area'] = area
         gdf['lon'] = gdf.geometry.x
         gdf['lat'] = gdf.geometry.y
-        gdf['geometry'] = buf.to_crs(4326)
+        gdf['geometry'] = buf
         layer = ''
         
     elif (ext in ['gpkg', 'GPKG', 'shp', 'SHP', 'geojson', 'json']):
-        layer = fiona.listlayers(path_)[0]
-        gdf = gpd.read_file(path_)
+        if layer is None:
+            layer = fiona.listlayers(path_)[0]
+        gdf = gpd.read_file(path_, layer=layer)
         crs = gdf.crs.srs
         if not(crs in ['epsg:4326', 'EPSG:4326']):
             print(f'Update CRS from {crs} to epsg:4326')
@@ -87,7 +169,7 @@ def get_input(path_, rad_=5000):
         geom_type = str(gdf.geometry.values[0])[0:5]
         if (geom_type == 'POINT'):
             print('Creating buffer around points')
-            buf = gdf.to_crs(3857).buffer(rad_)
+            buf, area = geodesic_circles(gdf.geometry.x, gdf.geometry.y, rad_, nvert=nvert)
 
             cols = gdf.columns.values
             lat = [c if c.lower() in ['lat','latitude','y'] else 'NA' for c in cols]
@@ -97,85 +179,270 @@ def get_input(path_, rad_=5000):
             lon = list(filter(('NA').__ne__, lon))[0]
 
             gdf = gdf.drop(columns=[lon,lat])
-            gdf['area'] = 1e-6*buf.area
+            gdf['area'] = area
             gdf['lon'] = gdf.geometry.x
             gdf['lat'] = gdf.geometry.y
-            gdf['geometry'] = buf.to_crs(4326)
+            gdf['geometry'] = buf
         
     return gdf, layer
 
-def get_voronoi(gdf_):
-    # This function creates voronoi tasselations based on the
-    # points provided in the input geodataframe. 
-    # This geodataframe should contain (lon, lat) of each 
-    # point/centroid.
-
-    vor = None
-    print('Creating Voronoi diagram')
-    b = gdf_.bounds.describe()
-    cx = gdf_['lon']
-    cy = gdf_['lat']
-    
-    x1,y1 = b.loc['min','minx']-10, b.loc['min','miny']-10
-    x2,y2 = b.loc['max','maxx']+10, b.loc['max','maxy']+10
-    bounds = [(x1,y1),(x2,y1),(x2,y2),(x1,y2),(x1,y1)]
-    coords = np.concatenate((np.stack([cx.tolist(), cy.tolist()], axis=1), bounds))
-    v = Voronoi(coords)
-    lines = [LineString(v.vertices[line]) for line in 
-             v.ridge_vertices if -1 not in line]
-    vor = gpd.GeoDataFrame(geometry=lines)
-    return vor
-
-def non_overlaps(geom, line):
-    # Clipping geometry (geom) with lines (line)
-    # where the original centroid is inside the
-    # clipped geometry.
-
-    line.append(geom.boundary)
-    centroid = geom.centroid
-    merged = linemerge(line)
-    borders = unary_union(merged)
-    polygons = np.array(list(polygonize(borders)))
-    is_inside = [centroid.within(g) for g in polygons]
-    
-    return polygons[is_inside][0]
+def voronoi_cells(x, y, env):
+    # One Voronoi cell per point (x, y), limited to the envelope (env).
+    # Each point lies inside its own cell. Identical points share one cell.
+    pts = shapely.points(x, y)
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(pts), extend_to=env))
+    ipt, icell = shapely.STRtree(cells).query(pts, predicate='intersects')
+    first = np.unique(ipt, return_index=True)[1]
+    own = np.full(len(pts), env, dtype=object)
+    own[ipt[first]] = cells[icell[first]]
+    return own
+
+def get_voronoi_cells(gdf_):
+    # This function creates one Voronoi cell (polygon) per point, following
+    # the order of the rows in the input geodataframe. The geodataframe
+    # should contain (lon, lat) of each point/centroid.
+
+    print('Creating Voronoi cells')
+    x1,y1,x2,y2 = gdf_.total_bounds
+    env = shapely.box(x1-10, y1-10, x2+10, y2+10)
+    return voronoi_cells(gdf_['lon'].values, gdf_['lat'].values, env)
+
+def neighbour_graph(rows, cols, n):
+    # Symmetric neighbour lists (CSR-like indptr, indices) of n points
+    # from the pairs (rows, cols), without self links
+    link = rows != cols
+    adj = sparse.csr_matrix((np.ones(np.sum(link)), (rows[link], cols[link])), shape=(n, n))
+    adj = (adj + adj.T).tocsr()
+    adj.sort_indices()
+    return adj.indptr.astype(int), adj.indices.astype(int)
+
+def delaunay_neighbours(x, y):
+    # Neighbours of every point in the Delaunay triangulation (CSR-like
+    # indptr, indices). The triangulation is made of the distinct
+    # positions: identical points are linked to each other and share the
+    # neighbours of their position. Positions left out of the triangulation
+    # (coplanar) are linked to their nearest vertex.
+    n = len(x)
+    xy, inv = np.unique(np.stack([x, y], axis=1), axis=0, return_inverse=True)
+    inv = inv.ravel()
+    m = len(xy)
+    if m < 4:
+        rows, cols = np.repeat(np.arange(m), m), np.tile(np.arange(m), m)
+    else:
+        try:
+            tri = Delaunay(xy)
+        except QhullError:
+            tri = Delaunay(xy, qhull_options='QJ')
+        indptr, indices = tri.vertex_neighbor_vertices
+        rows = np.concatenate([np.repeat(np.arange(m), np.diff(indptr)), tri.coplanar[:,0]])
+        cols = np.concatenate([indices, tri.coplanar[:,2]])
+
+    # Position graph (with self links for the identical points) expanded to the points
+    ptr, idx = neighbour_graph(rows, cols, m)
+    pos = sparse.csr_matrix((np.ones(len(idx)), idx, ptr), shape=(m, m)) + sparse.identity(m)
+    member = sparse.csr_matrix((np.ones(n), (np.arange(n), inv)), shape=(n, m))
+    adj = (member @ pos @ member.T).tocoo()
+    return neighbour_graph(adj.row, adj.col, n)
+
+def get_tessellation(gdf_):
+    # The Voronoi cell of a point only depends on its Delaunay neighbours.
+    # Keeping these neighbours allows the cells to be updated locally
+    # when points are added or removed (see update_cells).
+
+    print('Creating Delaunay triangulation')
+    x = gdf_['lon'].values.astype(float)
+    y = gdf_['lat'].values.astype(float)
+    indptr, indices = delaunay_neighbours(x, y)
+    return {'lon':x, 'lat':y, 'indptr':indptr, 'indices':indices}
+
+def voronoi_path(geom_path):
+    # The tessellation is stored next to the geometry file
+    return os.path.splitext(geom_path)[0] + '_voronoi.npz'
+
+def save_tessellation(tess, path):
+    np.savez(path, lon=tess['lon'], lat=tess['lat'], indptr=tess['indptr'], indices=tess['indices'])
+
+def load_tessellation(path, gdf_):
+    # Returns None if the file is missing or made for other points
+    if not(os.path.isfile(path)):
+        return None
+    with np.load(path) as f:
+        tess = {k:f[k] for k in ['lon', 'lat', 'indptr', 'indices']}
+    if not(np.array_equal(tess['lon'], gdf_['lon'].values) and
+           np.array_equal(tess['lat'], gdf_['lat'].values)):
+        return None
+    return tess
+
+def exact_cells(cells, x, y, tree):
+    # A cell computed from a subset of the points is exact if none of its
+    # vertices is closer to another point (of the full set, in tree) than
+    # to its own point.
+    coords, idx = shapely.get_coordinates(cells, return_index=True)
+    own = np.hypot(coords[:,0] - x[idx], coords[:,1] - y[idx])
+    nearest, _ = tree.query(coords)
+    bad = nearest < own - 1e-9*(1 + own)
+    return np.bincount(idx, weights=bad, minlength=len(cells)) == 0
+
+def exact_triangles(x, y, items, tree):
+    # The triangles of the Delaunay triangulation of a subset of the points
+    # (x, y) around the points items are those of the full set (in tree)
+    # if none of their circumcircles contains another point.
+    xy = np.unique(np.stack([x, y], axis=1), axis=0)
+    if len(xy) < 4:
+        return True
+    try:
+        tri = Delaunay(xy)
+    except QhullError:
+        return True
+    _, at = cKDTree(xy).query(np.stack([x[items], y[items]], axis=1))
+    simplices = tri.simplices[np.isin(tri.simplices, at).any(axis=1)]
+    a, b, c = xy[simplices[:,0]], xy[simplices[:,1]], xy[simplices[:,2]]
+    d = 2*((a[:,0] - c[:,0])*(b[:,1] - c[:,1]) - (b[:,0] - c[:,0])*(a[:,1] - c[:,1]))
+    sa, sb = np.sum((a - c)**2, axis=1), np.sum((b - c)**2, axis=1)
+    ux = c[:,0] + (sa*(b[:,1] - c[:,1]) - sb*(a[:,1] - c[:,1]))/d
+    uy = c[:,1] + (sb*(a[:,0] - c[:,0]) - sa*(b[:,0] - c[:,0]))/d
+    rad = np.hypot(a[:,0] - ux, a[:,1] - uy)
+    inside = tree.query_ball_point(np.stack([ux, uy], axis=1), rad*(1 - 1e-9), return_length=True)
+    return np.all(inside == 0)
+
+def update_cells(tess, removed, x_add, y_add, env):
+    # Updating the tessellation (in place) after removing some points
+    # (positions in tess) and appending new points (x_add, y_add).
+    # Only the cells of the old neighbours of the removed points, of the
+    # new points and of their new neighbours change. These cells are
+    # computed from a local subset of the points, which is grown until
+    # every cell passes exact_cells and the triangles around them pass
+    # exact_triangles. Identical points are always taken (and changed)
+    # together, as they share their neighbours.
+    # This function returns the positions of the changed cells in the new
+    # numbering (remaining points in their order, then the new points)
+    # and the cells themselves.
+
+    x0, y0 = tess['lon'], tess['lat']
+    indptr, indices = tess['indptr'], tess['indices']
+    n0 = len(x0)
+    keep = np.ones(n0, dtype=bool)
+    keep[removed] = False
+    new_pos = np.full(n0, -1)
+    new_pos[keep] = np.arange(np.sum(keep))
+    x = np.concatenate([x0[keep], np.asarray(x_add, dtype=float)])
+    y = np.concatenate([y0[keep], np.asarray(y_add, dtype=float)])
+    n = len(x)
+    added = np.arange(n - len(x_add), n)
+
+    def ring(items):
+        # items and their neighbours (old numbering)
+        nb = [indices[indptr[i]:indptr[i+1]] for i in items]
+        return np.unique(np.concatenate([np.asarray(items, dtype=int)] + nb))
+
+    changed_old = np.setdiff1d(ring(removed), removed)
+    tree = cKDTree(np.stack([x, y], axis=1))
+    seeds = np.concatenate([np.asarray(removed, dtype=int), changed_old])
+    if (len(added) > 0) and (np.sum(keep) > 0):
+        _, near = cKDTree(np.stack([x0[keep], y0[keep]], axis=1)).query(np.stack([x[added], y[added]], axis=1))
+        seeds = np.concatenate([seeds, np.flatnonzero(keep)[near]])
+    local = ring(ring(seeds)) if len(seeds) > 0 else seeds
+    # The points of the convex hull are always used, so that the long
+    # edges of the hull are also found by the local triangulation
+    hull = shapely.get_coordinates(shapely.convex_hull(shapely.multipoints(np.stack([x, y], axis=1))))
+    _, hull = tree.query(hull)
+
+    def twins(items):
+        # items and the points identical to them (new numbering)
+        tw = tree.query_ball_point(np.stack([x[items], y[items]], axis=1), r=0)
+        return np.unique(np.concatenate([np.asarray(items, dtype=int)] + [np.asarray(t, dtype=int) for t in tw]))
+
+    while True:
+        loc = twins(np.concatenate([new_pos[local[keep[local]]], added, hull]))
+        pos = np.full(n, -1)
+        pos[loc] = np.arange(len(loc))
+        cells_loc = voronoi_cells(x[loc], y[loc], env)
+        nb_ptr, nb_idx = delaunay_neighbours(x[loc], y[loc])
+
+        # Changed cells: old neighbours of the removed points, the added points
+        # and their new neighbours
+        nb_add = [loc[nb_idx[nb_ptr[i]:nb_ptr[i+1]]] for i in pos[added]]
+        changed = twins(np.concatenate([new_pos[changed_old], added] + nb_add))
+        ok = exact_cells(cells_loc[pos[changed]], x[changed], y[changed], tree)
+        if (np.all(ok) and exact_triangles(x[loc], y[loc], pos[changed], tree)) or (len(loc) >= n):
+            break
+        grown = ring(local)
+        if len(grown) == len(local):
+            grown = np.arange(n0)
+        local = grown
+
+    # Neighbours of the changed points come from the local triangulation,
+    # the others keep their links to the unchanged points (they never had
+    # a removed neighbour). The graph is made symmetric again.
+    is_changed = np.zeros(n, dtype=bool)
+    is_changed[changed] = True
+    old_rows = new_pos[np.repeat(np.arange(n0), np.diff(indptr))]
+    old_cols = new_pos[indices]
+    sel = (old_rows >= 0) & (old_cols >= 0)
+    sel[sel] = ~is_changed[old_rows[sel]] & ~is_changed[old_cols[sel]]
+    loc_rows = loc[np.repeat(np.arange(len(loc)), np.diff(nb_ptr))]
+    loc_cols = loc[nb_idx]
+    own = is_changed[loc_rows]
+    tess['lon'], tess['lat'] = x, y
+    tess['indptr'], tess['indices'] = neighbour_graph(np.concatenate([old_rows[sel], loc_rows[own]]),
+                                                      np.concatenate([old_cols[sel], loc_cols[own]]), n)
+    cells = cells_loc[pos[changed]]
+    print(f'Updated Voronoi cells: {len(changed)} of {n}')
+    return changed, cells
+
+def clip_to_cells(geoms, cells):
+    # Clipping every buffer with its own Voronoi cell
+    return shapely.intersection(np.asarray(geoms), cells)
 
-def add_rows(gdf0, gdf1, clip=True, col='LOCATION_ID'):
+def same_geometry(g0, g1):
+    # Element-wise check whether the geometries cover the same area
+    # (up to floating point noise)
+    d = shapely.area(shapely.symmetric_difference(g0, g1))
+    return d <= 1e-12*np.maximum(shapely.area(g0), 1e-12)
+
+def edit_envelope(*gdfs):
+    # Envelope of the Voronoi cells (see get_voronoi_cells)
+    b = np.array([g.total_bounds for g in gdfs if len(g) > 0])
+    return shapely.box(b[:,0].min()-10, b[:,1].min()-10, b[:,2].max()+10, b[:,3].max()+10)
+
+def add_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', tess=None):
     # Updating the old buffer by adding new items from
     # the additional file. The buffers affected by this 
-    # addition will be re-clipped.
+    # addition will be re-clipped. If tess (see get_tessellation)
+    # is given, it is updated to the new points.
     gdf1['remark'] = 'new'
     print(f'Add {len(gdf1)} items to the old buffers')
     if clip:
-        pts = pd.concat([gdf0, gdf1], ignore_index=True).reset_index(drop=True)
-        vor = get_voronoi(pts)
+        if tess is None:
+            tess = get_tessellation(gdf0)
+        n0 = len(gdf0)
+        changed, cells = update_cells(tess, [], gdf1.lon.values, gdf1.lat.values,
+                                      edit_envelope(gdf0, gdf1))
         print(f'Clipping additional buffers: {len(gdf1)}++')
-        for i,row in tqdm(gdf1.iterrows(), total=gdf1.shape[0]):
-            b0 = row['geometry'].bounds
-            g1 = vor.cx[b0[0]:b0[2], b0[1]:b0[3]]
-            if (len(g1) > 0):
-                non = non_overlaps(row.geometry, g1.geometry.tolist())
-                gdf1.loc[i,'geometry'] = non
-
-            g2 = gdf0.cx[b0[0]:b0[2], b0[1]:b0[3]]
-            for j,item in g2.iterrows():
-                b0 = item['geometry'].bounds
-                g1 = vor.cx[b0[0]:b0[2], b0[1]:b0[3]]
-                if len(g1) > 0:
-                    non = non_overlaps(item.geometry, g1.geometry.tolist())
-                    gdf0.loc[j,'geometry'] = non
-                    gdf0.loc[j,'remark'] = 'new'
+        gdf1['geometry'] = clip_to_cells(gdf1.geometry.values, cells[changed >= n0])
+
+        aff = changed[changed < n0]
+        geom = clip_to_cells(gdf0.geometry.values[aff], cells[changed < n0])
+        diff = ~same_geometry(geom, gdf0.geometry.values[aff])
+        rows = gdf0.index[aff[diff]]
+        gdf0.loc[rows, 'geometry'] = geom[diff]
+        gdf0.loc[rows, 'remark'] = 'new'
         
     gdf0 = pd.concat([gdf0, gdf1], ignore_index=True).reset_index(drop=True)
+    n = len(gdf0)
     gdf0 = gdf0.drop_duplicates(subset=[col], keep='last')
     gdf0 = gpd.GeoDataFrame(gdf0, geometry='geometry')
+    if clip and (len(gdf0) < n):
+        tess.update(get_tessellation(gdf0))
 
     return gdf0
 
-def del_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000):
+def del_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000, tess=None, nvert=64):
     # Deleting selected rows from the old buffer
     # based on the IDs listed in the secondary input file. 
     # The buffers affected by this process will be re-clipped.
+    # If tess (see get_tessellation) is given, it is updated
+    # to the remaining points.
 
     sel = gdf0[col].isin(gdf1[col].values)
     nsel = np.sum(sel)
@@ -183,34 +450,51 @@ def del_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000):
         print(f'{col} for deletion is not in the old buffers')
         return gdf0
     
-    rem = gdf0[sel].copy()
+    if clip:
+        if tess is None:
+            tess = get_tessellation(gdf0)
+        changed, cells = update_cells(tess, np.flatnonzero(sel), [], [], edit_envelope(gdf0))
+
     gdf0 = gdf0[~sel].reset_index(drop=True)
-    vor0 = get_voronoi(gdf0)
     print(f'Delete {np.sum(sel)} items from the old buffers')
 
     if clip:
-        old_buf = buffer_from_points(gdf0.lon, gdf0.lat, rad, as_gdf=True)
-        rem_buf = buffer_from_points(rem.lon, rem.lat, rad, as_gdf=False)
-        print(f'Check affected buffers for re-clipping')
-        for buf in tqdm(rem_buf):
-            b0 = buf.bounds
-            g2 = old_buf.cx[b0[0]:b0[2], b0[1]:b0[3]]
-            for j,item in g2.iterrows():
-                b2 = item['geometry'].bounds
-                g1 = vor0.cx[b2[0]:b2[2], b2[1]:b2[3]]
-                if len(g1) > 0:
-                    non = non_overlaps(item.geometry, g1.geometry.tolist())
-                    gdf0.loc[j,'geometry'] = non
-                    gdf0.loc[j,'remark'] = 'new'
+        print(f'Re-clipping affected buffers')
+        circ = buffer_from_points(gdf0.lon.values[changed], gdf0.lat.values[changed], rad, nvert=nvert)
+        geom = clip_to_cells(circ, cells)
+        diff = ~same_geometry(geom, gdf0.geometry.values[changed])
+        gdf0.loc[changed[diff], 'geometry'] = geom[diff]
+        gdf0.loc[changed[diff], 'remark'] = 'new'
         
     return gdf0
 
-def edt_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000):
-    # Adding, editing, or removing rows from the secondary input file. 
-    # The buffers affected by this process will be re-clipped.
-
+def edit_split(gdf1):
+    # Items of the secondary input file to remove and to add
+    # (edited items are both)
     to_rem = gdf1[gdf1['remark'].isin(['remove', 'delete', 'edit'])].copy().reset_index(drop=True)
     to_add = gdf1[gdf1['remark'].isin(['add', 'new', 'edit'])].copy().reset_index(drop=True)
+    return to_rem, to_add
+
+def edit_update(gdf0, gdf1, tess, col='LOCATION_ID'):
+    # Updating the tessellation (in place) for the edits listed in gdf1
+    # and returning the changed cells (see update_cells). The cells do not
+    # depend on the buffer radius, so the result can be passed to edt_rows
+    # for every radius. None is returned if there is nothing to edit.
+    to_rem, to_add = edit_split(gdf1)
+    sel = gdf0[col].isin(to_rem[col].values)
+    if np.sum(sel) < 1:
+        return None
+    return update_cells(tess, np.flatnonzero(sel), to_add.lon.values,
+                        to_add.lat.values, edit_envelope(gdf0, to_add))
+
+def edt_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000, tess=None, nvert=64, update=None):
+    # Adding, editing, or removing rows from the secondary input file. 
+    # Only the buffers whose Voronoi cells have changed are re-clipped.
+    # If tess (see get_tessellation) is given, it is updated to the
+    # new points, unless the changed cells are already given (update,
+    # see edit_update).
+
+    to_rem, to_add = edit_split(gdf1)
     
     sel = gdf0[col].isin(to_rem[col].values)
     nsel = np.sum(sel)
@@ -220,39 +504,27 @@ def edt_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000):
     else:
         print(f'Delete {nsel} items from the old buffers')
     
+    if clip:
+        if update is None:
+            if tess is None:
+                tess = get_tessellation(gdf0)
+            update = edit_update(gdf0, gdf1, tess, col=col)
+        changed, cells = update
+
     gdf0 = gdf0[~sel].reset_index(drop=True)
 
     if clip:
-        old_buf = buffer_from_points(gdf0.lon.values, gdf0.lat.values, rad, as_gdf=True)
-        
-        #edt_ = pd.concat([rem, to_add], ignore_index=True)
-        edt_buf = buffer_from_points(gdf1.lon.values, gdf1.lat.values, rad, as_gdf=False)
-
-        new_buf = pd.concat([gdf0, to_add], ignore_index=True).reset_index(drop=True)
-        print(len(new_buf))
-        vor = get_voronoi(new_buf)
-    
-        print(f'Check affected buffers for re-clipping')
-        for buf in tqdm(edt_buf):
-            b0 = buf.bounds
-            g2 = old_buf.cx[b0[0]:b0[2], b0[1]:b0[3]]
-            for j,item in g2.iterrows():
-                b2 = item['geometry'].bounds
-                g1 = vor.cx[b2[0]:b2[2], b2[1]:b2[3]]
-                gdf0.loc[j,'remark'] = 'reclip'
-                if len(g1) > 0:
-                    non = non_overlaps(item.geometry, g1.geometry.tolist())
-                    gdf0.loc[j,'geometry'] = non
-                else:
-                    gdf0.loc[j,'geometry'] = item.geometry
+        n0 = len(gdf0)
+        aff = changed[changed < n0]
+        print(f'Re-clipping affected buffers')
+        circ = buffer_from_points(gdf0.lon.values[aff], gdf0.lat.values[aff], rad, nvert=nvert)
+        geom = clip_to_cells(circ, cells[changed < n0])
+        diff = ~same_geometry(geom, gdf0.geometry.values[aff])
+        gdf0.loc[aff[diff], 'remark'] = 'reclip'
+        gdf0.loc[aff[diff], 'geometry'] = geom[diff]
         
         print(f'Clipping newly added buffers: {len(to_add)}++')
-        for i,row in tqdm(to_add.iterrows(), total=to_add.shape[0]):
-            b0 = row['geometry'].bounds
-            g1 = vor.cx[b0[0]:b0[2], b0[1]:b0[3]]
-            if (len(g1) > 0):
-                non = non_overlaps(row.geometry, g1.geometry.tolist())
-                to_add.loc[i,'geometry'] = non
+        to_add['geometry'] = clip_to_cells(to_add.geometry.values, cells[changed >= n0])
         
     gdf0 = pd.concat([gdf0, to_add], ignore_index=True).reset_index(drop=True)
     #gdf0 = gdf0.drop_duplicates(subset=[col], keep='last')
@@ -260,13 +532,104 @@ def edt_rows(gdf0, gdf1, clip=True, col='LOCATION_ID', rad=5000):
 
     return gdf0
 
+CACHE_VERSION = 1
+
+def file_digest(path, h=None):
+    # SHA1 of the file content, read in chunks
+    if h is None:
+        h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h
+
+def cache_key(paths, params):
+    # Key of a cache entry: content of the input files and the parameters
+    h = hashlib.sha1(f'get_buffer-{CACHE_VERSION}'.encode())
+    for path in paths:
+        if path:
+            file_digest(path, h)
+        h.update(b'|')
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+def cache_fetch(cache_dir, key, outputs):
+    # Restoring the output files from the cache entry. Files that are
+    # already identical to the cached ones are left untouched.
+    # Returns False if the entry is missing or incomplete.
+    entry = os.path.join(cache_dir, key)
+    cached = [os.path.join(entry, os.path.basename(p)) for p in outputs]
+    if not(all([os.path.isfile(c) for c in cached])):
+        return False
+    for c,p in zip(cached, outputs):
+        if (os.path.isfile(p) and (os.path.getsize(p) == os.path.getsize(c)) and
+            (file_digest(p).digest() == file_digest(c).digest())):
+            continue
+        shutil.copyfile(c, p)
+    os.utime(entry)
+    return True
+
+def cache_store(cache_dir, key, outputs, max_size):
+    # Adding the output files to the cache and evicting the least
+    # recently used entries above max_size (MB)
+    entry = os.path.join(cache_dir, key)
+    tmp = f'{entry}.tmp{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    for p in outputs:
+        shutil.copyfile(p, os.path.join(tmp, os.path.basename(p)))
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    os.replace(tmp, entry)
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not('.tmp' in name):
+            size = sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+            entries.append((os.path.getmtime(path), size, path))
+    total = 0
+    for _,size,path in sorted(entries, reverse=True):
+        total += size
+        if (total > max_size*2**20) and (path != entry):
+            print('Removing cached buffers:', os.path.basename(path))
+            shutil.rmtree(path)
+
+def output_paths(outfile, clip=False, unclipped=False):
+    # Files written by get_buffer
+    if not(clip):
+        return [f'{outfile}.gpkg']
+    outputs = [f'{outfile}_clipped.gpkg', voronoi_path(f'{outfile}_clipped.gpkg')]
+    if unclipped:
+        outputs.append(f'{outfile}.gpkg')
+    return outputs
+
+def read_layers(path_, radii, nvert=64):
+    # Buffers of every radius (kilometre) stored in the layers of path_.
+    # A single-layer file (written before multiple radii were supported)
+    # is accepted for a single radius.
+    layers = fiona.listlayers(path_)
+    gdfs = []
+    for rad in radii:
+        layer = layer_name(rad)
+        if not(layer in layers):
+            if (len(layers) == 1) and (len(radii) == 1):
+                layer = layers[0]
+            else:
+                print(f'Layer {layer_name(rad)} is not found in', path_)
+                sys.exit(1)
+        gdfs.append(get_input(path_, rad_=1000*rad, nvert=nvert, layer=layer)[0])
+    return gdfs
+
 def get_buffer(argv=None):
     infile = 'input'
     edtfile = None
-    rad = 5
+    radii = [5]
     id_col = 'LOCATION_ID'
     outfile = 'output'
     clip = False
+    unclipped = False
+    nvert = 64
+    cache_size = 0
 
     if argv is None:
         argv = sys.argv
@@ -296,47 +659,100 @@ def get_buffer(argv=None):
         elif(arg in ['--id']):
             id_col = argv[i+suf]
         elif(arg in ['-r', '--rad']):
-            rad = float(argv[i+suf])
+            radii = argv[i+suf]
+            if isinstance(radii, str):
+                radii = radii.replace(' ','').split(',')
+            radii = [float(r) for r in np.atleast_1d(radii)]
         elif(arg in ['-o', '--output']):
             outfile = argv[i+suf]
         elif(arg in ['-c', '--clip']):
             clip = True
+        elif(arg in ['-u', '--unclipped']):
+            unclipped = True
+        elif(arg in ['-n', '--nvert']):
+            nvert = int(argv[i+suf])
+        elif(arg in ['--cache']):
+            cache_size = float(argv[i+suf])
         elif(arg in ['-h', '--help']):
             usage()
             sys.exit(1)
 
-    gd0, layer = get_input(infile, rad_=1000*rad)
-    gd0['remark'] = 'old'
-    
+    outputs = output_paths(outfile, clip, unclipped)
+    if cache_size > 0:
+        # The buffers only depend on the input files and the parameters
+        cache_dir = os.path.join(os.path.dirname(outfile), '.cache')
+        params = {'radii':radii, 'clip':clip, 'unclipped':unclipped, 'nvert':nvert,
+                  'id':id_col, 'edit':bool(edtfile), 'output':os.path.basename(outfile)}
+        key = cache_key([infile, edtfile], params)
+        if cache_fetch(cache_dir, key, outputs):
+            print('Buffers are found in cache:', key)
+            return
+
+    tess = None
     if edtfile:
         # Updating the coordinates of the items listed in
         # the secondary input file. The buffers affected by this 
-        # process will be re-clipped.
-        gd1, _ = get_input(edtfile, rad_=1000*rad)
-        gd0 = edt_rows(gd0, gd1, clip=clip, col=id_col, rad=1000*rad)
-
-    elif clip:
-        # Perform clipping to the buffers to avoid overlaps.        
-        pts  = gd0.copy()
-        vor = get_voronoi(pts)
-        print(f'Clipping buffers: {len(gd0)}')
-        for i,row in tqdm(gd0.iterrows(), total=gd0.shape[0]):
-            b0 = row['geometry'].bounds
-            g1 = vor.cx[b0[0]:b0[2], b0[1]:b0[3]]
-            if (len(g1) > 0):
-                non = non_overlaps(row.geometry, g1.geometry.tolist())
-                gd0.loc[i,'geometry'] = non
-        gd0['remark'] = 'new'
-
-    suffix = ''
+        # process will be re-clipped. The tessellation stored with
+        # the input file is used if it matches the input points.
+        # The changed Voronoi cells are computed once for all radii.
+        gdfs = read_layers(infile, radii, nvert=nvert)
+        gd1, _ = get_input(edtfile, rad_=1000*radii[0], nvert=nvert)
+        update = None
+        if clip:
+            tess = load_tessellation(voronoi_path(infile), gdfs[0])
+            if tess is None:
+                tess = get_tessellation(gdfs[0])
+            update = edit_update(gdfs[0], gd1, tess, col=id_col)
+        for k,rad in enumerate(radii):
+            gdfs[k]['remark'] = 'old'
+            gdfs[k] = edt_rows(gdfs[k], with_radius(gd1, 1000*rad, nvert=nvert), clip=clip,
+                               col=id_col, rad=1000*rad, tess=tess, nvert=nvert, update=update)
+
+    else:
+        # The input is read once, the buffers of the other radii are
+        # created around the same points.
+        gd0, _ = get_input(infile, rad_=1000*radii[0], nvert=nvert)
+        gd0['remark'] = 'old'
+        gdfs = [with_radius(gd0, 1000*rad, nvert=nvert) for rad in radii]
+
+        if clip:
+            # Perform clipping to the buffers to avoid overlaps.
+            # The Voronoi cells are shared by all radii.
+            cells = get_voronoi_cells(gdfs[0])
+            for gd in gdfs:
+                print(f'Clipping buffers: {len(gd)}')
+                gd['geometry'] = clip_to_cells(gd.geometry.values, cells)
+                gd['remark'] = 'new'
+            tess = get_tessellation(gdfs[0])
+
+    variants = [('', gdfs)]
     if clip:
-        suffix = '_clipped'
-    
-    gd0 = gd0.reset_index(drop=True)
-    gd0['area'] = 1e-6*gd0.to_crs(3857).area
-    print('Saving geometry file', outfile)    
-    gd0.to_file(f'{outfile}_{rad:.0f}km{suffix}.gpkg', index=False, 
-                mode='w', driver='GPKG', layer=layer)
+        variants = [('_clipped', gdfs)]
+        if unclipped:
+            # Unclipped buffers are the circles around the same points.
+            # Only the added items are new to them.
+            circ = []
+            for gd,rad in zip(gdfs, radii):
+                gd = with_radius(gd, 1000*rad, nvert=nvert)
+                gd.loc[gd['remark'] == 'reclip', 'remark'] = 'old'
+                circ.append(gd)
+            variants.append(('', circ))
+
+    for suffix,gds in variants:
+        outpath = f'{outfile}{suffix}.gpkg'
+        print('Saving geometry file', outpath)
+        if os.path.isfile(outpath):
+            os.remove(outpath)
+        for gd,rad in zip(gds, radii):
+            gd = gd.reset_index(drop=True)
+            gd['area'] = geodesic_area(gd.geometry.values)
+            gd.to_file(outpath, index=False, mode='w', driver='GPKG', layer=layer_name(rad))
+        if (suffix == '_clipped') and (tess is not None):
+            save_tessellation(tess, voronoi_path(outpath))
+
+    if cache_size > 0:
+        print('Caching buffers:', key)
+        cache_store(cache_dir, key, outputs, cache_size)
     
 if __name__ == '__main__':
-    sys.exit(get_buffer())
\ No newline at end of file
+    sys.exit(get_buffer())
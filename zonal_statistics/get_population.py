@@ -4,10 +4,11 @@ import os
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from rasterstats import zonal_stats, point_query
-from datetime import date
+import rasterio
 
 import get_buffer
+import zonal_engine
+import pop_store
 from config import *
 
 def usage():
@@ -26,118 +27,155 @@ def initialize():
     if not('geom' in dirs):
         os.mkdir('geom')
 
-def get_population(zones, raster_path, min_area=1, interpolate='nearest'):
+def get_population(zones, raster_path, index=None, streaming=False, density=True):
+    # index: zone-to-pixel index with one row per zone (see zonal_engine.zone_index).
+    # Otherwise, the index of the zones is built on the grid of the raster.
+    # density: the raster values are people per km2 and the population is
+    # the sum of the densities times the area of the pixels covered by the
+    # zone (covered fraction x geodesic pixel area). Otherwise the values
+    # are people per pixel, weighted by the covered fraction only.
+    # Small zones (within a pixel) and large zones are treated alike.
+    # cell_count is the number of (covered fractions of) valid pixels.
+    # streaming: read the raster block by block (bounded memory).
     cols = zones.columns.values
     if not('area' in cols):
-        zones['area'] = 1e-6*zones.geometry.to_crs(3857).area
-    
-    small = zones['area'] < min_area
-    area_large = zones[~small]['area'].values
-    zones['pop'] = np.nan
-    zones['cell_count'] = 0
-    
-    res = zonal_stats(zones[~small], raster_path, stats=['count'], add_stats={'pop':np.nansum})
-    cnt_large = np.array([a['count'] for a in res])
-    pop_large = np.array([a['pop'] for a in res])
-
-    #ONLY DO SCALING WHEN THE PIXEL COUNT IS BIGGER THAN THE BUFFER AREA
-    a = np.where(cnt_large > area_large)
-    fac = np.ones(len(area_large))
-    fac[a] = area_large[a]/cnt_large[a]
-    pop_large = fac*np.array(pop_large)
-    zones.loc[~small, 'pop'] = pop_large
-    zones.loc[~small, 'cell_count'] = cnt_large
-
-    if (small.sum() > 0):
-        pts = gpd.points_from_xy(zones[small]['lon'], zones[small]['lat'], crs='epsg:4326')
-        pop_small = point_query(pts, raster_path, interpolate=interpolate)
-        pop_small = zones[small]['area'].values*np.array(pop_small, dtype=float)
-        zones.loc[small, 'pop'] = pop_small
-        zones.loc[small, 'cell_count'] = 1
-    
+        zones['area'] = get_buffer.geodesic_area(zones.geometry.values)
+
+    if index is None:
+        with rasterio.open(raster_path, 'r') as src:
+            grid = zonal_engine.raster_grid(src)
+        index = zonal_engine.build_index(zones.geometry.values, grid)
+    count, pop = zonal_engine.index_sums(index, raster_path, streaming=streaming, density=density)
+    pop[count == 0] = np.nan
+    zones['pop'] = pop
+    zones['cell_count'] = count
     return zones
 
+def migrate_buffers(path):
+    # Buffers produced before all radii were kept in one geopackage
+    # (geom/buffer_{rad}km_clipped.gpkg) are copied as layers of path
+    if not(all([os.path.isfile(f'geom/buffer_{rad:.0f}km_clipped.gpkg') for rad in radii])):
+        print('Buffer file is not found:', path)
+        sys.exit(1)
+    print('Copying buffers to', path)
+    for rad in radii:
+        gdf = gpd.read_file(f'geom/buffer_{rad:.0f}km_clipped.gpkg')
+        gdf.to_file(path, index=False, mode='w', driver='GPKG', layer=get_buffer.layer_name(rad))
+
 def main():
     initialize()
+    if not(raster_values in ['density', 'count']):
+        print('raster_values should be density or count')
+        sys.exit(1)
 
     if clipped_only:
         buffer_types = ['_clipped']
     else:
         buffer_types = ['_clipped', '']
 
+    # All radii and both buffer types are produced by a single
+    # call, one layer per radius (see get_buffer.py)
+    infile = 'geom/buffer_clipped.gpkg'
+    if processing_mode == 'new':
+        param = {'input':location, 'rad':radii, 'output':'geom/buffer'}
+    else:
+        if not(os.path.isfile(infile)):
+            migrate_buffers(infile)
+        param = {'input':infile, 'rad':radii, 'output':'geom/buffer', 'id':id_col}
+        param[processing_mode] = location
+    param['clip'] = True
+    if not(clipped_only):
+        param['unclipped'] = True
+    if cache_size > 0:
+        param['cache'] = cache_size
+    get_buffer.get_buffer(param)
+
+    # Every buffer type and radius is a layer with its own store and
+    # zone index. The zones of all layers are processed together, the
+    # overlapping (unclipped) buffers and the radii share one read of
+    # every population raster.
+    layers = []
     for buffer_type in buffer_types:
         for rad in radii:
-            infile = f'geom/buffer_{rad:.0f}km{buffer_type}.gpkg'
+            infile = f'geom/buffer{buffer_type}.gpkg'
+            layer = get_buffer.layer_name(rad)
             outfile = f'out/pop_{rad:.0f}km{buffer_type}.csv'
             
-            if processing_mode == 'new':
-                param = {'input':location, 'rad':rad, 'output':'geom/buffer'}
-            else:
-                param = {'input':infile, 'rad':rad, 'output':'geom/buffer', 'id':id_col}
-                param[processing_mode] = location
-            if buffer_type == '_clipped':
-                param['clip'] = True
-            
-            get_buffer.get_buffer(param)
-            buffer = gpd.read_file(infile)
+            buffer = gpd.read_file(infile, layer=layer)
+            zone_geoms = buffer.geometry.values
             #if not('remark' in buffer.columns.tolist()):
             #    buffer['remark'] = 'old'
 
             print('Processing:', outfile)
-            if processing_mode == 'new':
-                pop_df = pd.DataFrame(buffer).drop(columns=['geometry'])
-            else:
-                old_df = pd.read_csv(outfile)
-                old_df['remark'] = 'old'
+            store = pop_store.open_store(pop_store.store_path(outfile), id_col, history=versioning)
+            if processing_mode != 'new':
+                if (pop_store.zone_count(store) < 1) and os.path.isfile(outfile):
+                    pop_store.import_csv(store, outfile)
+                pop_store.new_run(store)
+
                 if processing_mode == 'edit':
                     del_df = pd.read_csv(location)
                     del_df = del_df[del_df.remark.isin(['remove','delete'])]
                     if len(del_df) > 0:
-                        sel = old_df[id_col].isin(del_df[id_col].values)
-                        if len(sel) > 0:
-                            old_df = old_df[~sel].reset_index(drop=True)                        
+                        print(f'Deleting {len(del_df)} items')
+                        pop_store.delete(store, del_df[id_col].values)
 
                 buffer = buffer[buffer['remark'] != 'old']
-                if (len(buffer) < 1):
-                    if processing_mode == 'delete':
-                        print(f'Deleting {np.sum(sel)} items')
-                        print('Saving population table:', outfile)
-                        old_df.to_csv(outfile, index=False)
-                    if versioning:
-                        today = date.today().strftime("%Y%m%d")
-                        dated_outfile = f'{outfile[:-4]}_{today}.csv'
-                        old_df.to_csv(dated_outfile, index=False)
-                    continue
-                pop_df = pd.DataFrame(buffer).drop(columns=['geometry'])
+            pop_df = pd.DataFrame(buffer).drop(columns=['geometry'])
 
             print('Number of (updated) zones:', len(buffer))
+            print()
             
             pop_df['remark'] = 'update'
-            for year in range(year_start, year_end+1):
-                pop_raster = raster_file.format(year=year)
-                
-                if not(os.path.isfile(pop_raster)):
-                    print('Population raster cannot be found:', pop_raster)
-                    sys.exit()
-                
-                print('Performing zonal statistics:', year)
-                pop = get_population(buffer, pop_raster)
-                pop_df[f'pop_{year}'] = pop['pop'].values
-                pop_df['cell_count'] = pop['cell_count'].values
-                
-            if processing_mode != 'new':
-                pop_df = pd.concat([old_df, pop_df], ignore_index=True)
-                pop_df = pop_df.drop_duplicates(subset=[id_col], keep='last')
+            layers.append({'infile':infile, 'layer':layer, 'outfile':outfile, 'buffer':buffer,
+                           'zone_geoms':zone_geoms, 'zone_index':None, 'store':store, 'pop_df':pop_df})
 
-            print('Saving population table:', outfile)
-            pop_df.to_csv(outfile, index=False)
+    todo = [l for l in layers if len(l['buffer']) > 0]
+    for year in range(year_start, year_end+1):
+        if len(todo) < 1:
+            break
+        pop_raster = raster_file.format(year=year)
+        
+        if not(os.path.isfile(pop_raster)):
+            print('Population raster cannot be found:', pop_raster)
+            sys.exit()
+        
+        # The zone index is shared by all rasters on the same grid.
+        # The rows of the updated zones of all layers are stacked.
+        for l in todo:
+            l['zone_index'] = zonal_engine.zone_index(l['infile'], l['zone_geoms'], pop_raster,
+                                                      index=l['zone_index'], workers=workers,
+                                                      layer=l['layer'])
+        index = zonal_engine.stack_indexes([zonal_engine.index_rows(l['zone_index'], l['buffer'].index.values)
+                                            for l in todo])
+        zones = pd.concat([l['buffer'] for l in todo], ignore_index=True)
 
-            if versioning:
-                today = date.today().strftime("%Y%m%d")
-                dated_outfile = f'{outfile[:-4]}_{today}.csv'
-                pop_df.to_csv(dated_outfile, index=False)
+        print('Performing zonal statistics:', year)
+        pop = get_population(zones, pop_raster, index=index, streaming=streaming,
+                             density=(raster_values == 'density'))
+        start = np.cumsum([0] + [len(l['buffer']) for l in todo])
+        for k,l in enumerate(todo):
+            l['pop_df'][f'pop_{year}'] = pop['pop'].values[start[k]:start[k+1]]
+            l['pop_df']['cell_count'] = pop['cell_count'].values[start[k]:start[k+1]]
 
-            print()
+    # Only the updated zones are written to the store (in new mode, the
+    # zones differing from the current table of the store), the CSV table
+    # is exported from it
+    for l in layers:
+        if processing_mode == 'new':
+            prev = None
+            if pop_store.zone_count(l['store']) > 0:
+                prev = pop_store.read_table(l['store'])
+                if set(prev.columns) != set(l['pop_df'].columns):
+                    prev = None
+            pop_store.apply_table(l['store'], l['pop_df'], prev)
+            pop_store.touch(l['store'])
+        else:
+            pop_store.upsert(l['store'], l['pop_df'])
+        if export_csv:
+            pop_store.export_csv(l['store'], l['outfile'])
+        l['store'].close()
+    print()
             
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
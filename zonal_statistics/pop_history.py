@@ -0,0 +1,104 @@
+import os
+import sys
+import glob
+
+import pop_store
+
+def usage():
+    print('Usage: python pop_history.py -s out/pop_10km_clipped.sqlite [OPTIONS]')
+    print('Options:')
+    print('-s, --store       [required] Path to the population store (see get_population.py)')
+    print('-l, --list                   List the recorded versions.')
+    print('-v, --version                Export the table of a version, given as the version')
+    print('                             number or as a date (YYYYMMDD).')
+    print('-d, --diff                   Zones added, removed, or changed between two')
+    print('                             versions separated by comma (e.g. 20240101,20240301).')
+    print('-i, --import                 Record dated CSV tables (pop_*_YYYYMMDD.csv) written')
+    print('                             by earlier versions as the history of the store.')
+    print('                             Glob patterns are accepted (use quotes).')
+    print('--id                         ID column name. Default value: LOCATION_ID')
+    print('-o, --output                 Output CSV file. Otherwise, a summary is printed.')
+    print('-h, --help                   Show this message and exit.')
+    print('')
+    print('Example: python pop_history.py -s out/pop_10km_clipped.sqlite -v 20240301 -o pop_20240301.csv')
+    print()
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+    if len(argv) < 3:
+        sys.exit(usage())
+
+    store_file = None
+    version = None
+    diff = None
+    snapshots = None
+    id_col = 'LOCATION_ID'
+    output_file = None
+    do_list = False
+
+    i = 1
+    while i < len(argv):
+        if (argv[i] in ['-s', '--store']):
+            store_file = argv[i+1]
+        elif (argv[i] in ['-l', '--list']):
+            do_list = True
+            i += 1
+            continue
+        elif (argv[i] in ['-v', '--version']):
+            version = argv[i+1]
+        elif (argv[i] in ['-d', '--diff']):
+            diff = argv[i+1].replace(' ','').split(',')
+            if len(diff) != 2:
+                print('Two versions are required for the difference')
+                sys.exit(1)
+        elif (argv[i] in ['-i', '--import']):
+            snapshots = []
+            for p in argv[i+1].split(','):
+                snapshots += sorted(glob.glob(p))
+        elif (argv[i] in ['--id']):
+            id_col = argv[i+1]
+        elif (argv[i] in ['-o', '--output']):
+            output_file = argv[i+1]
+        elif (argv[i] in ['-h', '--help']):
+            usage()
+            sys.exit(1)
+        i += 2
+
+    if store_file is None:
+        print('Population store is not given')
+        sys.exit(1)
+    if (snapshots is None) and not(os.path.isfile(store_file)):
+        print('Population store is not found:', store_file)
+        sys.exit(1)
+    con = pop_store.open_store(store_file, id_col)
+
+    if snapshots is not None:
+        if len(snapshots) < 1:
+            print('No table to import')
+            sys.exit(1)
+        pop_store.import_snapshots(con, snapshots)
+        do_list = True
+
+    if do_list:
+        print(pop_store.list_versions(con).to_string(index=False))
+
+    df = None
+    if version is not None:
+        v = pop_store.find_version(con, version)
+        print('Reconstructing version', v)
+        df = pop_store.version_table(con, v)
+        print('Number of zones:', len(df))
+    elif diff is not None:
+        v1, v2 = [pop_store.find_version(con, v) for v in diff]
+        print(f'Comparing version {v1} and {v2}')
+        df = pop_store.diff_versions(con, v1, v2)
+        print(df['change'].value_counts().to_string())
+
+    if (df is not None) and (output_file is not None):
+        print('Saving table:', output_file)
+        df.to_csv(output_file, index=False)
+    con.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
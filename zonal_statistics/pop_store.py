@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+import sqlite3
+from datetime import date
+import numpy as np
+import pandas as pd
+
+'''
+Purpose: population table store used by get_population.py. The zones
+         and their population (one row per zone and year) are kept in
+         a SQLite database, so edits only touch the changed rows. The
+         CSV table is exported from the store.
+         With history, every run is a version and the changes of the
+         zones and population values are logged, so the table of any
+         version can be reconstructed (see pop_history.py).
+'''
+
+def store_path(csv_path):
+    # The store is kept next to the CSV table
+    return os.path.splitext(csv_path)[0] + '.sqlite'
+
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def to_python(values):
+    # SQLite only accepts python scalars
+    return [None if (isinstance(v, float) and np.isnan(v)) else
+            (v.item() if isinstance(v, np.generic) else v) for v in values]
+
+def open_store(path, id_col='LOCATION_ID', history=None):
+    # Opening (or creating) the store. The zones table gets the
+    # attribute columns of the zones as they are written.
+    # history: record the changes of every run (True) or not (False).
+    # The setting kept in the store is used if it is None.
+    con = sqlite3.connect(path)
+    con.execute(f'CREATE TABLE IF NOT EXISTS zones ({quote(id_col)} PRIMARY KEY, run INTEGER)')
+    con.execute(f'CREATE TABLE IF NOT EXISTS pop ({quote(id_col)}, year INTEGER, pop REAL, '
+                f'PRIMARY KEY ({quote(id_col)}, year)) WITHOUT ROWID')
+    con.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+
+    # Change logs: a zone row (as JSON) or its deletion, and a population
+    # value, each tagged with the version (run) in which it was written.
+    # A reset version (new processing) starts the table from scratch.
+    con.execute('CREATE TABLE IF NOT EXISTS versions (version INTEGER PRIMARY KEY, day TEXT, '
+                'reset INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS zones_log (version INTEGER, id, deleted INTEGER, data TEXT)')
+    con.execute('CREATE TABLE IF NOT EXISTS pop_log (version INTEGER, id, year INTEGER, pop REAL)')
+    con.execute('CREATE INDEX IF NOT EXISTS zones_log_idx ON zones_log (version, id)')
+    con.execute('CREATE INDEX IF NOT EXISTS pop_log_idx ON pop_log (version, id, year)')
+    if history is not None:
+        con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('history', ?)", (int(history),))
+    con.commit()
+    return con
+
+def has_history(con):
+    row = con.execute("SELECT value FROM meta WHERE key = 'history'").fetchone()
+    return (row is not None) and bool(row[0])
+
+def zone_columns(con):
+    return [r[1] for r in con.execute('PRAGMA table_info(zones)')]
+
+def id_column(con):
+    return zone_columns(con)[0]
+
+def zone_count(con):
+    return con.execute('SELECT COUNT(*) FROM zones').fetchone()[0]
+
+def current_run(con):
+    row = con.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+    return 0 if row is None else int(row[0])
+
+def new_run(con, reset=False, day=None):
+    # Every edit is a new run. The zones written during the last run are
+    # exported with remark 'update', the others with 'old'.
+    # With history, the run is a new version dated day (YYYYMMDD, today
+    # by default). reset: the table is created again in this run.
+    run = current_run(con) + 1
+    con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('run', ?)", (run,))
+    if has_history(con):
+        if day is None:
+            day = date.today().strftime("%Y%m%d")
+        first = con.execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 0
+        con.execute('INSERT OR REPLACE INTO versions (version, day, reset) VALUES (?, ?, ?)',
+                    (run, str(day), int(reset or first)))
+    con.commit()
+    return run
+
+def touch(con):
+    # Marking all zones as written in the current run (exported with
+    # remark 'update'), without recording them in the history
+    con.execute('UPDATE zones SET run = ?', (current_run(con),))
+    con.commit()
+
+def clear(con):
+    # Removing all zones (new processing)
+    con.execute('DELETE FROM zones')
+    con.execute('DELETE FROM pop')
+    con.commit()
+
+def split_table(df):
+    # Zone attributes and population columns (pop_<year>) of a table
+    years = [int(c[4:]) for c in df.columns if c.startswith('pop_') and c[4:].isdigit()]
+    attrs = [c for c in df.columns if not(c in [f'pop_{y}' for y in years])]
+    return attrs, years
+
+def upsert(con, df, run=None):
+    # Inserting or replacing the zones in df (one row per zone with the
+    # pop_<year> columns) together with their population values
+    id_col = id_column(con)
+    attrs, years = split_table(df)
+    cols = zone_columns(con)
+    for c in attrs:
+        if not(c in cols):
+            con.execute(f'ALTER TABLE zones ADD COLUMN {quote(c)}')
+            cols.append(c)
+    if run is None:
+        run = current_run(con)
+
+    ids = to_python(df[id_col].values)
+    rows = list(zip(*[to_python(df[c].values) for c in attrs], [run]*len(df)))
+    names = ', '.join([quote(c) for c in attrs + ['run']])
+    marks = ', '.join(['?']*(len(attrs) + 1))
+    con.execute('BEGIN')
+    con.executemany(f'INSERT OR REPLACE INTO zones ({names}) VALUES ({marks})', rows)
+    for y in years:
+        con.executemany(f'INSERT OR REPLACE INTO pop ({quote(id_col)}, year, pop) VALUES (?, ?, ?)',
+                        zip(ids, [y]*len(df), to_python(df[f'pop_{y}'].values)))
+    if has_history(con):
+        data = [json.dumps(dict(zip(attrs, r[:-1]))) for r in rows]
+        con.executemany('INSERT INTO zones_log (version, id, deleted, data) VALUES (?, ?, 0, ?)',
+                        zip([run]*len(df), ids, data))
+        for y in years:
+            con.executemany('INSERT INTO pop_log (version, id, year, pop) VALUES (?, ?, ?, ?)',
+                            zip([run]*len(df), ids, [y]*len(df), to_python(df[f'pop_{y}'].values)))
+    con.commit()
+
+def delete(con, ids):
+    # Removing zones and their population values
+    id_col = id_column(con)
+    ids = [(i,) for i in to_python(np.asarray(ids))]
+    con.execute('BEGIN')
+    con.executemany(f'DELETE FROM zones WHERE {quote(id_col)} = ?', ids)
+    con.executemany(f'DELETE FROM pop WHERE {quote(id_col)} = ?', ids)
+    if has_history(con):
+        run = current_run(con)
+        con.executemany('INSERT INTO zones_log (version, id, deleted) VALUES (?, ?, 1)',
+                        [(run, i[0]) for i in ids])
+    con.commit()
+    return len(ids)
+
+def import_csv(con, csv_path):
+    # Filling the store from a population table written before the
+    # store existed
+    print('Importing population table:', csv_path)
+    df = pd.read_csv(csv_path)
+    df['remark'] = 'old'
+    upsert(con, df, run=new_run(con, reset=True))
+
+def read_table(con):
+    # Population table with one row per zone and the pop_<year> columns.
+    # The cell_count column is kept last as in the CSV tables.
+    id_col = id_column(con)
+    zones = pd.read_sql_query('SELECT * FROM zones', con)
+    pop = pd.read_sql_query('SELECT * FROM pop', con)
+    if 'remark' in zones.columns:
+        zones.loc[zones['run'] != current_run(con), 'remark'] = 'old'
+    zones = zones.drop(columns=['run'])
+    pop = pop.pivot(index=id_col, columns='year', values='pop')
+    pop.columns = [f'pop_{y}' for y in pop.columns]
+    df = zones.merge(pop, left_on=id_col, right_index=True, how='left')
+    if 'cell_count' in df.columns:
+        df = df[[c for c in df.columns if c != 'cell_count'] + ['cell_count']]
+    return df
+
+def export_csv(con, csv_path):
+    print('Saving population table:', csv_path)
+    read_table(con).to_csv(csv_path, index=False)
+
+def list_versions(con):
+    return pd.read_sql_query('SELECT * FROM versions ORDER BY version', con)
+
+def find_version(con, spec):
+    # Version from its number or from a date (YYYYMMDD, the last version
+    # of that day or before)
+    spec = str(spec)
+    versions = list_versions(con)
+    if len(versions) < 1:
+        print('No history is recorded in the store')
+        sys.exit(1)
+    if len(spec) == 8:
+        sel = versions[versions['day'] <= spec]
+    else:
+        sel = versions[versions['version'] == int(spec)]
+    if len(sel) < 1:
+        print('Version is not found:', spec)
+        sys.exit(1)
+    return int(sel['version'].values[-1])
+
+def last_reset(con, version):
+    row = con.execute('SELECT MAX(version) FROM versions WHERE reset = 1 AND version <= ?',
+                      (version,)).fetchone()
+    return 0 if row[0] is None else row[0]
+
+def select_ids(con, ids):
+    # Temporary table of zone ids used to restrict the log queries
+    con.execute('DROP TABLE IF EXISTS temp.sel')
+    con.execute('CREATE TEMP TABLE sel (id PRIMARY KEY)')
+    if ids is not None:
+        con.executemany('INSERT OR IGNORE INTO sel (id) VALUES (?)', [(i,) for i in to_python(np.asarray(ids))])
+    return '' if ids is None else 'AND id IN (SELECT id FROM sel)'
+
+def version_table(con, version, ids=None):
+    # Table (as exported) of the given version, reconstructed from the
+    # logs since the last reset. Only the zones in ids if given.
+    id_col = id_column(con)
+    first = last_reset(con, version)
+    only = select_ids(con, ids)
+
+    log = pd.read_sql_query(f'SELECT z.version, z.id, z.deleted, z.data FROM zones_log z JOIN '
+                            f'(SELECT MAX(rowid) AS r FROM zones_log WHERE version BETWEEN ? AND ? {only} '
+                            f'GROUP BY id) m ON z.rowid = m.r ORDER BY z.rowid', con,
+                            params=(first, version))
+    log = log[log['deleted'] == 0]
+    zones = pd.DataFrame([json.loads(d) for d in log['data']], index=log.index)
+    if len(zones) < 1:
+        zones = pd.DataFrame(columns=[id_col])
+    if 'remark' in zones.columns:
+        zones.loc[log['version'].values != version, 'remark'] = 'old'
+
+    # Population values written after the last deletion of the zone
+    pop = pd.read_sql_query(f'SELECT p.version, p.id, p.year, p.pop FROM pop_log p JOIN '
+                            f'(SELECT MAX(rowid) AS r FROM pop_log WHERE version BETWEEN ? AND ? {only} '
+                            f'GROUP BY id, year) m ON p.rowid = m.r', con, params=(first, version))
+    dels = pd.read_sql_query(f'SELECT id, MAX(version) AS deleted FROM zones_log WHERE deleted = 1 '
+                             f'AND version BETWEEN ? AND ? {only} GROUP BY id', con, params=(first, version))
+    pop = pop.merge(dels, on='id', how='left')
+    pop = pop[pop['version'] >= pop['deleted'].fillna(-1)]
+    pop = pop.pivot(index='id', columns='year', values='pop')
+    pop.columns = [f'pop_{y}' for y in pop.columns]
+
+    df = zones.merge(pop, left_on=id_col, right_index=True, how='left')
+    if 'cell_count' in df.columns:
+        df = df[[c for c in df.columns if c != 'cell_count'] + ['cell_count']]
+    return df.reset_index(drop=True)
+
+def table_changes(t1, t2):
+    # Ids (index) of the rows added, removed, or changed from t1 to t2
+    added = t2.index.difference(t1.index)
+    removed = t1.index.difference(t2.index)
+    both = t2.index.intersection(t1.index)
+    a = t1.reindex(index=both, columns=t2.columns)
+    b = t2.loc[both]
+    same = ((a == b) | (a.isna() & b.isna())).all(axis=1)
+    return added, removed, both[~same.values]
+
+def diff_versions(con, v1, v2):
+    # Zones added, removed, or changed between two versions. Only the
+    # zones logged between the versions are reconstructed. The rows of
+    # v2 (v1 for the removed zones) are returned with a change column.
+    id_col = id_column(con)
+    v1, v2 = min(v1, v2), max(v1, v2)
+    ids = None
+    if last_reset(con, v2) <= v1:
+        ids = pd.read_sql_query('SELECT id FROM zones_log WHERE version > ? AND version <= ? UNION '
+                                'SELECT id FROM pop_log WHERE version > ? AND version <= ?', con,
+                                params=(v1, v2, v1, v2))['id'].values
+    t1 = version_table(con, v1, ids).drop(columns=['remark'], errors='ignore').set_index(id_col)
+    t2 = version_table(con, v2, ids).drop(columns=['remark'], errors='ignore').set_index(id_col)
+
+    added, removed, changed = table_changes(t1, t2)
+    df = pd.concat([t2.loc[added].assign(change='added'),
+                    t1.loc[removed].assign(change='removed'),
+                    t2.loc[changed].assign(change='changed')])
+    return df.reset_index()
+
+def apply_table(con, df, prev=None, day=None):
+    # Recording the table df as a new version, writing only the
+    # rows that differ from the previous table (prev)
+    id_col = id_column(con)
+    new_run(con, reset=(prev is None), day=day)
+    if prev is None:
+        clear(con)
+        upsert(con, df)
+        return
+    t1 = prev.drop(columns=['remark'], errors='ignore').set_index(id_col)
+    t2 = df.drop(columns=['remark'], errors='ignore').set_index(id_col)
+    added, removed, changed = table_changes(t1, t2)
+    delete(con, removed)
+    upsert(con, df[df[id_col].isin(added.union(changed))])
+
+def import_snapshots(con, paths):
+    # Recording dated tables (<name>_YYYYMMDD.csv) written by earlier
+    # versions as the history of the store. The current table of the
+    # store, if any, is kept as the last version.
+    if len(list_versions(con)) > 0:
+        print('History is already recorded in the store')
+        sys.exit(1)
+    current = read_table(con) if zone_count(con) > 0 else None
+    con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('history', 1)")
+
+    prev = None
+    for path in sorted(paths, key=lambda p: os.path.splitext(p)[0][-8:]):
+        day = os.path.splitext(path)[0][-8:]
+        if not(day.isdigit()):
+            print('Date (YYYYMMDD) is not found in the file name:', path)
+            sys.exit(1)
+        print('Importing population table:', path)
+        df = pd.read_csv(path)
+        apply_table(con, df, prev, day=day)
+        prev = df
+    if current is not None:
+        apply_table(con, current, prev)
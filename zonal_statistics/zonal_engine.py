@@ -0,0 +1,904 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import shapely
+import rasterio
+from scipy import sparse
+from rasterio import features
+from rasterio.warp import transform as warp_transform
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.windows import Window, from_bounds
+
+import get_buffer
+
+'''
+Purpose: shared zonal reduction routines used by zonal_statistics.py
+         and get_population.py
+'''
+
+VALID_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median',
+               'majority', 'minority', 'unique', 'range', 'nodata', 'nan']
+
+# Statistics that can be merged from partial aggregates (streaming mode)
+STREAM_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'range']
+
+def check_stats(stats):
+    # Make sure that every requested statistic can be computed.
+    # percentile_q (e.g. percentile_90) is accepted as well.
+    for s in stats:
+        if s.startswith('percentile_'):
+            q = float(s[11:])
+            if not(0 <= q <= 100):
+                raise ValueError(f'Percentile should be between 0 and 100: {s}')
+        elif not(s in VALID_STATS):
+            raise ValueError(f'Stat {s} is not valid. Use one of {VALID_STATS}')
+
+def zone_layers(geoms):
+    # Assigning the zones into layers such that zones in the same layer
+    # do not touch or overlap each other. Every layer can then be burnt
+    # into a single label grid without one zone overwriting another.
+    # Non-overlapping zones (e.g. clipped buffers) end up in a handful of
+    # layers, disjoint zones in a single one.
+
+    geoms = np.asarray(geoms)
+    layer = np.full(len(geoms), -1, dtype=int)
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate='intersects')
+    keep = left != right
+    left, right = left[keep], right[keep]
+    order = np.argsort(left, kind='stable')
+    left, right = left[order], right[order]
+    start = np.searchsorted(left, np.arange(len(geoms)))
+    end = np.searchsorted(left, np.arange(len(geoms)), side='right')
+
+    for i in range(len(geoms)):
+        taken = set(layer[right[start[i]:end[i]]])
+        k = 0
+        while k in taken:
+            k += 1
+        layer[i] = k
+    return layer
+
+def bounds_window(bounds, transform, width, height):
+    # Integer window covering the bounds, limited to the raster extent.
+    # None is returned when the bounds fall outside the raster.
+
+    win = from_bounds(*bounds, transform=transform)
+    col0 = max(int(np.floor(win.col_off)), 0)
+    row0 = max(int(np.floor(win.row_off)), 0)
+    col1 = min(int(np.ceil(win.col_off + win.width)), width)
+    row1 = min(int(np.ceil(win.row_off + win.height)), height)
+    if (col1 <= col0) or (row1 <= row0):
+        return None
+    return Window(col0, row0, col1-col0, row1-row0)
+
+def zones_window(src, geoms):
+    # Integer raster window covering all zones, limited to the raster extent.
+    # None is returned when the zones fall outside the raster.
+
+    geoms = np.asarray(geoms)
+    geoms = geoms[~shapely.is_empty(geoms)]
+    if len(geoms) < 1:
+        return None
+    b = shapely.total_bounds(geoms)
+    return bounds_window(b, src.transform, src.width, src.height)
+
+def burn_labels(geoms, ids, transform, shape, all_touched=False):
+    # Rasterizing the zones into a label grid. Pixel value is the
+    # zone id + 1, 0 marks the pixels outside of every zone.
+
+    shapes = [(g, i+1) for g,i in zip(geoms, ids) if not(g is None or g.is_empty)]
+    if len(shapes) < 1:
+        return np.zeros(shape, dtype='int32')
+    return features.rasterize(shapes, out_shape=shape, transform=transform,
+                              fill=0, dtype='int32', all_touched=all_touched)
+
+def valid_mask(values, nodata):
+    # Pixels that are neither nodata nor NaN
+    valid = np.ones(values.shape, dtype=bool)
+    if nodata is not None:
+        valid &= values != nodata
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    return valid
+
+def new_stats(n, stats):
+    # Per-zone result arrays. Zones without any valid pixel keep NaN,
+    # except count (and the nodata/nan counters) which keep 0.
+    res = {}
+    for s in stats:
+        if s in ['count', 'unique']:
+            res[s] = np.zeros(n, dtype=int)
+        elif s in ['nodata', 'nan']:
+            res[s] = np.zeros(n)
+        else:
+            res[s] = np.full(n, np.nan)
+    return res
+
+def reduce_labels(labels, values, nodata, stats, res):
+    # Reducing one band over a label grid. Results of the zones found
+    # in the grid are written into res (see new_stats).
+
+    n = len(next(iter(res.values())))
+    labels = labels.ravel()
+    values = values.ravel()
+    inside = labels > 0
+    valid = valid_mask(values, nodata) & inside
+    idx = labels[valid] - 1
+    val = values[valid].astype(float)
+
+    count = np.bincount(idx, minlength=n)
+    has = count > 0
+    total = np.bincount(idx, weights=val, minlength=n)
+    mean = np.divide(total, count, out=np.zeros(n), where=has)
+
+    if 'count' in stats:
+        res['count'][has] = count[has]
+    if 'sum' in stats:
+        res['sum'][has] = total[has]
+    if 'mean' in stats:
+        res['mean'][has] = mean[has]
+    if 'std' in stats:
+        dev = np.bincount(idx, weights=(val - mean[idx])**2, minlength=n)
+        res['std'][has] = np.sqrt(dev[has]/count[has])
+    if ('min' in stats) or ('range' in stats):
+        vmin = np.full(n, np.inf)
+        np.minimum.at(vmin, idx, val)
+    if ('max' in stats) or ('range' in stats):
+        vmax = np.full(n, -np.inf)
+        np.maximum.at(vmax, idx, val)
+    if 'min' in stats:
+        res['min'][has] = vmin[has]
+    if 'max' in stats:
+        res['max'][has] = vmax[has]
+    if 'range' in stats:
+        res['range'][has] = vmax[has] - vmin[has]
+    if 'nodata' in stats and nodata is not None:
+        nd = inside & (values == nodata)
+        res['nodata'] += np.bincount(labels[nd] - 1, minlength=n)
+    if 'nan' in stats and np.issubdtype(values.dtype, np.floating):
+        nn = inside & np.isnan(values)
+        res['nan'] += np.bincount(labels[nn] - 1, minlength=n)
+
+    # Order statistics need the values of every zone, grouped by sorting
+    # the labels once.
+    others = [s for s in stats if s in ['median', 'majority', 'minority', 'unique']
+              or s.startswith('percentile_')]
+    if len(others) < 1:
+        return res
+    order = np.argsort(idx, kind='stable')
+    groups = np.split(val[order], np.cumsum(count)[:-1])
+    for z in np.flatnonzero(has):
+        g = groups[z]
+        if 'median' in others:
+            res['median'][z] = np.median(g)
+        if ('majority' in others) or ('minority' in others) or ('unique' in others):
+            keys, cnt = np.unique(g, return_counts=True)
+            if 'majority' in others:
+                res['majority'][z] = keys[np.argmax(cnt)]
+            if 'minority' in others:
+                res['minority'][z] = keys[np.argmin(cnt)]
+            if 'unique' in others:
+                res['unique'][z] = len(keys)
+        for s in others:
+            if s.startswith('percentile_'):
+                res[s][z] = np.percentile(g, float(s[11:]))
+    return res
+
+def label_stats(geoms, raster_path, band_indexes=[1], stats=['count','min','max','mean'],
+                nodata=None, all_touched=False):
+    # Zonal statistics of several bands with a single raster read.
+    # The zones (in the CRS of the raster) are burnt into label grids
+    # once, then every requested band is reduced over those grids.
+    # This function returns {band_index: DataFrame} with one row per zone,
+    # following the order of geoms.
+
+    check_stats(stats)
+    geoms = np.asarray(geoms)
+    n = len(geoms)
+    res = {int(b):new_stats(n, stats) for b in band_indexes}
+
+    with rasterio.open(raster_path, 'r') as src:
+        if nodata is None:
+            nodata = src.nodata
+        win = zones_window(src, geoms)
+        if win is not None:
+            transform = src.window_transform(win)
+            shape = (int(win.height), int(win.width))
+            data = src.read([int(b) for b in band_indexes], window=win)
+
+            layer = zone_layers(geoms)
+            for k in np.unique(layer):
+                ids = np.flatnonzero(layer == k)
+                labels = burn_labels(geoms[ids], ids, transform, shape, all_touched=all_touched)
+                for j,b in enumerate(band_indexes):
+                    reduce_labels(labels, data[j], nodata, stats, res[int(b)])
+
+    return {b:pd.DataFrame(r)[stats] for b,r in res.items()}
+
+def new_partials(n):
+    # Mergeable partial aggregates of n zones
+    return {'count':np.zeros(n, dtype='int64'), 'sum':np.zeros(n), 'sumsq':np.zeros(n),
+            'min':np.full(n, np.inf), 'max':np.full(n, -np.inf)}
+
+def update_partials(p, labels, values, nodata):
+    # Adding the pixels of a label grid (zone id + 1, 0 outside) to the partials
+    labels = labels.ravel()
+    values = values.ravel()
+    valid = valid_mask(values, nodata) & (labels > 0)
+    idx = labels[valid] - 1
+    val = values[valid].astype(float)
+    n = len(p['count'])
+    p['count'] += np.bincount(idx, minlength=n)
+    p['sum'] += np.bincount(idx, weights=val, minlength=n)
+    p['sumsq'] += np.bincount(idx, weights=val*val, minlength=n)
+    np.minimum.at(p['min'], idx, val)
+    np.maximum.at(p['max'], idx, val)
+    return p
+
+def merge_partials(p, q):
+    # Combining two sets of partials of the same zones
+    return {'count':p['count'] + q['count'], 'sum':p['sum'] + q['sum'],
+            'sumsq':p['sumsq'] + q['sumsq'], 'min':np.minimum(p['min'], q['min']),
+            'max':np.maximum(p['max'], q['max'])}
+
+def partial_stats(p, stats):
+    # Final statistics from the partials
+    n = len(p['count'])
+    has = p['count'] > 0
+    res = new_stats(n, stats)
+    mean = np.divide(p['sum'], p['count'], out=np.zeros(n), where=has)
+    if 'count' in stats:
+        res['count'] = p['count'].astype(int)
+    if 'sum' in stats:
+        res['sum'][has] = p['sum'][has]
+    if 'mean' in stats:
+        res['mean'][has] = mean[has]
+    if 'std' in stats:
+        var = np.divide(p['sumsq'], p['count'], out=np.zeros(n), where=has) - mean**2
+        res['std'][has] = np.sqrt(np.maximum(var[has], 0))
+    if 'min' in stats:
+        res['min'][has] = p['min'][has]
+    if 'max' in stats:
+        res['max'][has] = p['max'][has]
+    if 'range' in stats:
+        res['range'][has] = p['max'][has] - p['min'][has]
+    return res
+
+def block_shape(src, min_rows=256, max_cols=4096):
+    # Shape of the reading blocks: the internal blocks of the raster.
+    # Striped rasters (blocks of a few rows) are read in strips of at
+    # least min_rows rows and at most max_cols columns.
+
+    bh, bw = src.block_shapes[0]
+    if bh < min_rows:
+        bh *= int(np.ceil(min_rows/bh))
+        bw = min(bw, max_cols)
+    return bh, bw
+
+def stream_windows(src, win, min_rows=256, max_cols=4096):
+    # Windows following the reading blocks of the raster within win
+    # (see block_shape).
+
+    bh, bw = block_shape(src, min_rows, max_cols)
+    row0 = (int(win.row_off)//bh)*bh
+    col0 = (int(win.col_off)//bw)*bw
+    row_end = int(win.row_off + win.height)
+    col_end = int(win.col_off + win.width)
+    for r in range(row0, row_end, bh):
+        for c in range(col0, col_end, bw):
+            r0, c0 = max(r, int(win.row_off)), max(c, int(win.col_off))
+            r1, c1 = min(r+bh, row_end), min(c+bw, col_end)
+            yield Window(c0, r0, c1-c0, r1-r0)
+
+def stream_stats(geoms, raster_path, band_indexes=[1], stats=['count','min','max','mean'],
+                 nodata=None, all_touched=False):
+    # Same as label_stats, but the raster is walked block by block.
+    # Only the zones touching a block are rasterized on that block and
+    # their partial aggregates are accumulated, so the peak memory
+    # depends on the block size rather than on the size of the zones.
+
+    for s in stats:
+        if not(s in STREAM_STATS):
+            raise ValueError(f'Stat {s} is not available in streaming mode. Use one of {STREAM_STATS}')
+    geoms = np.asarray(geoms)
+    n = len(geoms)
+    partials = {int(b):new_partials(n) for b in band_indexes}
+
+    with rasterio.open(raster_path, 'r') as src:
+        if nodata is None:
+            nodata = src.nodata
+        win = zones_window(src, geoms)
+        if win is not None:
+            tree = shapely.STRtree(geoms)
+            layer = zone_layers(geoms)
+            for w in stream_windows(src, win):
+                transform = src.window_transform(w)
+                bounds = rasterio.windows.bounds(w, src.transform)
+                cand = tree.query(shapely.box(*bounds), predicate='intersects')
+                if len(cand) < 1:
+                    continue
+                shape = (int(w.height), int(w.width))
+                data = src.read([int(b) for b in band_indexes], window=w)
+                for k in np.unique(layer[cand]):
+                    ids = np.sort(cand[layer[cand] == k])
+                    labels = burn_labels(geoms[ids], ids, transform, shape, all_touched=all_touched)
+                    for j,b in enumerate(band_indexes):
+                        update_partials(partials[int(b)], labels, data[j], nodata)
+
+    return {b:pd.DataFrame(partial_stats(p, stats))[stats] for b,p in partials.items()}
+
+def sample_points(x, y, raster_path, band_indexes=[1], method='nearest', nodata=None):
+    # Values of the raster at the points (x, y in the CRS of the raster),
+    # nearest pixel or bilinear interpolation between the centres of the
+    # four surrounding pixels. The pixels needed by all points are grouped
+    # by reading block (see block_shape) and every block is read once.
+    # Pixels that are nodata or outside the raster are left out of the
+    # interpolation; points without any valid pixel get NaN.
+    # This function returns {band_index: array} following the order of the points.
+
+    if not(method in ['nearest', 'bilinear']):
+        raise ValueError(f'Sampling method should be nearest or bilinear: {method}')
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    bands = [int(b) for b in band_indexes]
+
+    with rasterio.open(raster_path, 'r') as src:
+        if nodata is None:
+            nodata = src.nodata
+        col, row = ~src.transform*(x, y)
+        if method == 'nearest':
+            r = np.floor(row)[:,None]
+            c = np.floor(col)[:,None]
+            w = np.ones((n, 1))
+        else:
+            r0, c0 = np.floor(row - 0.5), np.floor(col - 0.5)
+            fr, fc = row - 0.5 - r0, col - 0.5 - c0
+            r = np.stack([r0, r0, r0 + 1, r0 + 1], axis=1)
+            c = np.stack([c0, c0 + 1, c0, c0 + 1], axis=1)
+            w = np.stack([(1 - fr)*(1 - fc), (1 - fr)*fc, fr*(1 - fc), fr*fc], axis=1)
+        inside = (r >= 0) & (r < src.height) & (c >= 0) & (c < src.width)
+        r = np.where(inside, r, 0).astype('int64')
+        c = np.where(inside, c, 0).astype('int64')
+
+        values = np.full((len(bands),) + r.shape, np.nan)
+        valid = np.zeros((len(bands),) + r.shape, dtype=bool)
+        bh, bw = block_shape(src)
+        block = (r//bh)*(-(-src.width//bw)) + c//bw
+        pix = np.flatnonzero(inside.ravel())
+        pix = pix[np.argsort(block.ravel()[pix], kind='stable')]
+        keys, start = np.unique(block.ravel()[pix], return_index=True)
+        for k,sel in zip(keys, np.split(pix, start[1:])):
+            br, bc = divmod(int(k), -(-src.width//bw))
+            win = Window(bc*bw, br*bh, min(bw, src.width - bc*bw), min(bh, src.height - br*bh))
+            data = src.read(bands, window=win)
+            i, j = np.unravel_index(sel, r.shape)
+            v = data[:, r[i,j] - br*bh, c[i,j] - bc*bw]
+            values[:, i, j] = v
+            valid[:, i, j] = valid_mask(v, nodata)
+
+    res = {}
+    for b,band in enumerate(bands):
+        wt = np.where(valid[b], w, 0)
+        total = np.sum(np.where(valid[b], values[b], 0)*wt, axis=1)
+        norm = np.sum(wt, axis=1)
+        res[band] = np.divide(total, norm, out=np.full(n, np.nan), where=norm > 0)
+    return res
+
+def spatial_chunks(geoms, nchunks):
+    # Splitting the zones into spatially coherent chunks of similar size
+    # by recursive bisection of the zone centres along the longer axis.
+    # Each chunk then covers a compact part of the raster.
+
+    b = shapely.bounds(np.asarray(geoms))
+    xy = np.nan_to_num(np.stack([b[:,0] + b[:,2], b[:,1] + b[:,3]], axis=1)/2)
+    chunks = [np.arange(len(xy))]
+    while len(chunks) < nchunks:
+        i = int(np.argmax([len(c) for c in chunks]))
+        c = chunks[i]
+        if len(c) < 2:
+            break
+        axis = int(np.argmax(xy[c].max(axis=0) - xy[c].min(axis=0)))
+        c = c[np.argsort(xy[c, axis], kind='stable')]
+        half = len(c)//2
+        chunks[i:i+1] = [c[:half], c[half:]]
+    return [np.sort(c) for c in chunks if len(c) > 0]
+
+def parallel_stats(geoms, raster_path, band_indexes=[1], stats=['count','min','max','mean'],
+                   nodata=None, all_touched=False, workers=2, streaming=False):
+    # label_stats (or stream_stats) of spatial chunks of the zones
+    # running in a process pool. Every zone is reduced exactly as in
+    # the serial path, so the merged results are identical.
+
+    geoms = np.asarray(geoms)
+    func = stream_stats if streaming else label_stats
+    chunks = spatial_chunks(geoms, 4*workers)
+    print(f'Processing {len(chunks)} chunks with {workers} workers')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(func, geoms[c], raster_path, band_indexes, stats,
+                            nodata=nodata, all_touched=all_touched) for c in chunks]
+        parts = [j.result() for j in jobs]
+
+    res = {}
+    order = np.concatenate(chunks)
+    for b in band_indexes:
+        df = pd.concat([p[int(b)] for p in parts], ignore_index=True)
+        df.index = order
+        res[int(b)] = df.sort_index()
+    return res
+
+def circle_bounds(lon, lat, rad, crs):
+    # Bounds (xmin, ymin, xmax, ymax) of the geodesic circles of radius rad
+    # around the points, in the CRS of the raster
+    circles, _ = get_buffer.geodesic_circles(lon, lat, rad)
+    xy = shapely.get_coordinates(circles).reshape(len(circles), -1, 2)
+    x, y = xy[:,:,0], xy[:,:,1]
+    if not(crs.is_geographic):
+        x, y = warp_transform('EPSG:4326', crs, x.ravel(), y.ravel())
+        x, y = np.reshape(x, xy.shape[:2]), np.reshape(y, xy.shape[:2])
+    return np.stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)], axis=1)
+
+def prefix_stats(val, valid, ends, stats, res, row):
+    # Statistics of the growing prefixes val[:k] (k in ends) of values
+    # sorted by distance, from cumulative sums. Results are written in
+    # res at the positions row (one per prefix, see new_stats).
+
+    cnt = np.concatenate([[0], np.cumsum(valid)])[ends]
+    has = cnt > 0
+    v = np.where(valid, val, 0).astype(float)
+    # Sums are shifted by the first valid value to keep the variance accurate
+    shift = v[np.argmax(valid)] if valid.any() else 0
+    total = np.concatenate([[0], np.cumsum(np.where(valid, v - shift, 0))])[ends]
+    sumsq = np.concatenate([[0], np.cumsum(np.where(valid, (v - shift)**2, 0))])[ends]
+    mean = np.divide(total, cnt, out=np.zeros(len(ends)), where=has)
+    last = np.maximum(ends - 1, 0)
+    if 'count' in stats:
+        res['count'][row[has]] = cnt[has]
+    if 'sum' in stats:
+        res['sum'][row[has]] = (total + shift*cnt)[has]
+    if 'mean' in stats:
+        res['mean'][row[has]] = (mean + shift)[has]
+    if 'std' in stats:
+        var = np.divide(sumsq, cnt, out=np.zeros(len(ends)), where=has) - mean**2
+        res['std'][row[has]] = np.sqrt(np.maximum(var, 0))[has]
+    if has.any():
+        vmin = np.minimum.accumulate(np.where(valid, val, np.inf).astype(float))[last]
+        vmax = np.maximum.accumulate(np.where(valid, val, -np.inf).astype(float))[last]
+        if 'min' in stats:
+            res['min'][row[has]] = vmin[has]
+        if 'max' in stats:
+            res['max'][row[has]] = vmax[has]
+        if 'range' in stats:
+            res['range'][row[has]] = (vmax - vmin)[has]
+    if 'nodata' in stats:
+        res['nodata'][row] += np.concatenate([[0], np.cumsum(~valid & ~np.isnan(val.astype(float)))])[ends]
+    if 'nan' in stats:
+        res['nan'][row] += np.concatenate([[0], np.cumsum(np.isnan(val.astype(float)))])[ends]
+
+    # Order statistics are computed from the valid values of every prefix
+    others = [s for s in stats if s in ['median', 'majority', 'minority', 'unique']
+              or s.startswith('percentile_')]
+    if len(others) < 1:
+        return res
+    good = val[valid].astype(float)
+    for k,z in zip(cnt[has], row[has]):
+        g = good[:k]
+        if 'median' in others:
+            res['median'][z] = np.median(g)
+        if ('majority' in others) or ('minority' in others) or ('unique' in others):
+            keys, c = np.unique(g, return_counts=True)
+            if 'majority' in others:
+                res['majority'][z] = keys[np.argmax(c)]
+            if 'minority' in others:
+                res['minority'][z] = keys[np.argmin(c)]
+            if 'unique' in others:
+                res['unique'][z] = len(keys)
+        for s in others:
+            if s.startswith('percentile_'):
+                res[s][z] = np.percentile(g, float(s[11:]))
+    return res
+
+def hilbert_order(x, y, bits=16):
+    # Order of the points along a Hilbert curve over their bounds.
+    # Consecutive points in this order are close to each other, so
+    # they share most of the raster blocks they read.
+    n = 2**bits
+    cell = []
+    for v in [x, y]:
+        v = np.nan_to_num(np.asarray(v, dtype=float))
+        lo, hi = v.min(), v.max()
+        cell.append(((v - lo)/(hi - lo if hi > lo else 1)*(n - 1)).astype('int64'))
+    xi, yi = cell
+    d = np.zeros(len(xi), dtype='int64')
+    s = n//2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s*s*((3*rx) ^ ry)
+        flip = ~ry & rx
+        xi, yi = np.where(flip, n - 1 - xi, xi), np.where(flip, n - 1 - yi, yi)
+        xi, yi = np.where(ry, xi, yi), np.where(ry, yi, xi)
+        s //= 2
+    return np.argsort(d, kind='stable')
+
+def block_cache(src, band_indexes=[1], max_size=256):
+    # Cache of the decoded reading blocks of the raster (see block_shape),
+    # the least recently used blocks are dropped above max_size (MB).
+    # hits and misses count the blocks found in or read into the cache.
+    return {'src':src, 'bands':[int(b) for b in band_indexes], 'shape':block_shape(src),
+            'blocks':OrderedDict(), 'nbytes':0, 'max':max_size*2**20, 'hits':0, 'misses':0}
+
+def cached_read(cache, win):
+    # Window of the raster assembled from the blocks of the cache
+    src = cache['src']
+    bh, bw = cache['shape']
+    blocks = cache['blocks']
+    row0, col0 = int(win.row_off), int(win.col_off)
+    row1, col1 = row0 + int(win.height), col0 + int(win.width)
+    out = None
+    for br in range(row0//bh, (row1 - 1)//bh + 1):
+        for bc in range(col0//bw, (col1 - 1)//bw + 1):
+            key = (br, bc)
+            if key in blocks:
+                blocks.move_to_end(key)
+                cache['hits'] += 1
+            else:
+                cache['misses'] += 1
+                blocks[key] = src.read(cache['bands'], window=Window(bc*bw, br*bh, min(bw, src.width - bc*bw),
+                                                                     min(bh, src.height - br*bh)))
+                cache['nbytes'] += blocks[key].nbytes
+                while (cache['nbytes'] > cache['max']) and (len(blocks) > 1):
+                    cache['nbytes'] -= blocks.popitem(last=False)[1].nbytes
+            a = blocks[key]
+            if out is None:
+                out = np.empty((a.shape[0], row1 - row0, col1 - col0), dtype=a.dtype)
+            r0, r1 = max(row0, br*bh), min(row1, (br + 1)*bh)
+            c0, c1 = max(col0, bc*bw), min(col1, (bc + 1)*bw)
+            out[:, r0 - row0:r1 - row0, c0 - col0:c1 - col0] = a[:, r0 - br*bh:r1 - br*bh, c0 - bc*bw:c1 - bc*bw]
+    return out
+
+def cache_report(cache):
+    total = cache['hits'] + cache['misses']
+    print('Block cache: %d hits, %d misses (%.0f%% hit rate), %d blocks of %.0f MB kept'%(
+          cache['hits'], cache['misses'], 100*cache['hits']/max(total, 1), len(cache['blocks']),
+          cache['nbytes']/2**20))
+
+def radial_stats(lon, lat, radii, raster_path, band_indexes=[1], stats=['count','min','max','mean'],
+                 nodata=None, streaming=False, cache_size=256):
+    # Zonal statistics of circles of several radii (metre) around the
+    # points (lon, lat) without building the buffer polygons. The window
+    # of the largest radius around every point is taken from a single
+    # read of the raster, the pixels are sorted by the geodesic distance
+    # of their centre to the point and the statistics of every radius
+    # are those of a prefix of the sorted pixels. The cost follows the
+    # largest radius, not the sum of the radii.
+    # With streaming, the window of every point is assembled from a cache
+    # of raster blocks (cache_size MB, see block_cache) instead, and the
+    # points are visited along a Hilbert curve so that every block is
+    # decoded about once. The memory use is bounded by the cache size.
+    # This function returns {band_index: DataFrame} with one row per
+    # radius and point, the radii following each other (as the buffer
+    # zones of zonal_statistics.py).
+
+    check_stats(stats)
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    radii = np.asarray(radii, dtype=float)
+    n = len(lon)
+    res = {int(b):new_stats(n*len(radii), stats) for b in band_indexes}
+
+    with rasterio.open(raster_path, 'r') as src:
+        if nodata is None:
+            nodata = src.nodata
+        bounds = circle_bounds(lon, lat, radii.max(), src.crs)
+        if streaming:
+            cache = block_cache(src, band_indexes, cache_size)
+            transform, height, width = src.transform, src.height, src.width
+            points = hilbert_order(lon, lat)
+        else:
+            b = np.concatenate([bounds[:,:2].min(axis=0), bounds[:,2:].max(axis=0)])
+            win = bounds_window(b, src.transform, src.width, src.height)
+            if win is None:
+                return {b:pd.DataFrame(r)[stats] for b,r in res.items()}
+            data = src.read([int(b) for b in band_indexes], window=win)
+            transform = src.window_transform(win)
+            height, width = data.shape[1:]
+            points = range(n)
+
+        for i in points:
+            w = bounds_window(bounds[i], transform, width, height)
+            if w is None:
+                continue
+            if streaming:
+                values = cached_read(cache, w)
+            else:
+                values = data[:, w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width]
+            rows, cols = np.mgrid[w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width]
+            x, y = transform*(cols.ravel() + 0.5, rows.ravel() + 0.5)
+            if not(src.crs.is_geographic):
+                x, y = warp_transform(src.crs, 'EPSG:4326', x, y)
+            d = get_buffer.geodesic_distance(lon[i], lat[i], x, y)
+            order = np.argsort(d, kind='stable')
+            order = order[d[order] <= radii.max()]
+            ends = np.searchsorted(d[order], radii, side='right')
+            for j,band in enumerate(band_indexes):
+                val = values[j].ravel()[order]
+                prefix_stats(val, valid_mask(val, nodata), ends, stats, res[int(band)],
+                             np.arange(len(radii))*n + i)
+        if streaming:
+            cache_report(cache)
+
+    return {b:pd.DataFrame(r)[stats] for b,r in res.items()}
+
+def chunk_weights(geoms, grid, area):
+    # zone_weights of a list of zones (worker function)
+    return [zone_weights(g, grid, area) for g in geoms]
+
+INDEX_VERSION = 3
+
+# Largest single raster read of index_sums (bytes), beyond which the
+# window is read block by block
+MAX_WINDOW = 256*2**20
+
+def raster_grid(src):
+    # Description of the raster grid the zone index is built for
+    return {'crs':src.crs.to_wkt() if src.crs else '',
+            'transform':np.array(src.transform)[:6],
+            'shape':np.array([src.height, src.width])}
+
+def same_grid(g0, g1):
+    return ((g0['crs'] == g1['crs']) and np.array_equal(g0['shape'], g1['shape'])
+            and np.allclose(g0['transform'], g1['transform'], rtol=0, atol=1e-12))
+
+def geographic(grid):
+    return bool(grid['crs']) and rasterio.crs.CRS.from_wkt(str(grid['crs'])).is_geographic
+
+def pixel_area(grid):
+    # Area (km2) of the pixels of every row of the grid. On a geographic
+    # grid (EPSG:4326), the area of the band of latitude on the sphere of
+    # get_buffer; otherwise the planar area (CRS in metre), the same for
+    # all rows.
+    height = int(grid['shape'][0])
+    t = rasterio.Affine(*grid['transform'])
+    if not(geographic(grid)):
+        return np.full(height, 1e-6*abs(t.a*t.e))
+    lat = np.radians(np.clip(t.f + t.e*np.arange(height + 1), -90, 90))
+    band = np.abs(np.sin(lat[:-1]) - np.sin(lat[1:]))
+    return 1e-6*get_buffer.EARTH_RADIUS**2*np.radians(abs(t.a))*band
+
+def geometry_digests(geoms):
+    # SHA1 of the WKB of every geometry. These are used to recognise
+    # the zones whose pixels are already in a stored index.
+    wkb = shapely.to_wkb(np.asarray(geoms), hex=False)
+    return np.array([hashlib.sha1(w if w is not None else b'').digest() for w in wkb], dtype='S20')
+
+def index_path(geom_path, layer=None):
+    # The index is stored next to the geometry file (one per layer)
+    stem = os.path.splitext(geom_path)[0]
+    if layer:
+        stem = f'{stem}_{layer}'
+    return stem + '_index.npz'
+
+def zone_weights(geom, grid, area):
+    # Flat indexes (row*width + col) of the pixels covered by the zone and
+    # the covered fraction of every pixel. Pixels whose centre is inside
+    # and which are not crossed by the boundary are fully covered; the
+    # others are intersected with the zone, and the area of the piece is
+    # divided by the area of the pixel (area, per row, see pixel_area).
+    # The pieces are measured on the sphere for geographic grids.
+    height, width = grid['shape']
+    transform = rasterio.Affine(*grid['transform'])
+    empty = (np.zeros(0, dtype='int64'), np.zeros(0, dtype='float32'))
+    if geom is None or geom.is_empty:
+        return empty
+    win = bounds_window(geom.bounds, transform, width, height)
+    if win is None:
+        return empty
+    shape = (int(win.height), int(win.width))
+    wt = rasterio.windows.transform(win, transform)
+    touched = features.rasterize([(geom, 1)], out_shape=shape, fill=0, dtype='uint8',
+                                 transform=wt, all_touched=True).astype(bool)
+    centre = features.rasterize([(geom, 1)], out_shape=shape, fill=0, dtype='uint8',
+                                transform=wt).astype(bool)
+    edge = features.rasterize([(geom.boundary, 1)], out_shape=shape, fill=0, dtype='uint8',
+                              transform=wt, all_touched=True).astype(bool)
+    inner = centre & ~edge
+
+    r, c = np.nonzero((touched | edge) & ~inner)
+    x0, y0 = wt*(c, r)
+    x1, y1 = wt*(c + 1, r + 1)
+    pieces = shapely.intersection(geom, shapely.box(x0, y0, x1, y1))
+    rows = r + int(win.row_off)
+    if geographic(grid):
+        frac = get_buffer.geodesic_area(pieces)/area[rows]
+    else:
+        frac = 1e-6*shapely.area(pieces)/area[rows]
+    keep = frac > 0
+
+    ri, ci = np.nonzero(inner)
+    rows = np.concatenate([ri + int(win.row_off), rows[keep]]).astype('int64')
+    cols = np.concatenate([ci, c[keep]]) + int(win.col_off)
+    weights = np.concatenate([np.ones(len(ri)), np.minimum(frac[keep], 1)]).astype('float32')
+    order = np.argsort(rows*width + cols)
+    return (rows*width + cols)[order], weights[order]
+
+def build_index(geoms, grid, digests=None, reuse=None, workers=1):
+    # Sparse zone x pixel weight matrix (CSR, one row per zone, columns
+    # are the flat pixel indexes of the grid, values are the covered
+    # fractions of the pixels, see zone_weights). Rows of a previous index
+    # (reuse) with identical geometry digests are copied instead of
+    # being rasterized again. With workers > 1, the zones are rasterized
+    # in spatial chunks by a process pool. The area of the pixels of
+    # every row (pixel_area) is kept with the index.
+
+    geoms = np.asarray(geoms)
+    if digests is None:
+        digests = geometry_digests(geoms)
+    old = {}
+    if reuse is not None:
+        old = {d:i for i,d in enumerate(reuse['digests'])}
+
+    area = reuse['pixel_area'] if (reuse is not None) else pixel_area(grid)
+    rows = [None]*len(geoms)
+    todo = []
+    for j,d in enumerate(digests):
+        if d in old:
+            m = reuse['matrix']
+            i = old[d]
+            rows[j] = (m.indices[m.indptr[i]:m.indptr[i+1]], m.data[m.indptr[i]:m.indptr[i+1]])
+        else:
+            todo.append(j)
+    todo = np.array(todo, dtype=int)
+
+    if (workers > 1) and (len(todo) > 1):
+        chunks = [todo[c] for c in spatial_chunks(geoms[todo], 4*workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(chunk_weights, geoms[c], grid, area) for c in chunks]
+            for c,j in zip(chunks, jobs):
+                for k,pix in zip(c, j.result()):
+                    rows[k] = pix
+    else:
+        for k in todo:
+            rows[k] = zone_weights(geoms[k], grid, area)
+    print(f'Zone index: {len(todo)} zones rasterized, {len(geoms)-len(todo)} reused')
+
+    indptr = np.concatenate([[0], np.cumsum([len(r[0]) for r in rows])]).astype('int64')
+    indices = np.concatenate([r[0] for r in rows] + [np.zeros(0, dtype='int64')])
+    data = np.concatenate([r[1] for r in rows] + [np.zeros(0, dtype='float32')])
+    npix = int(grid['shape'][0])*int(grid['shape'][1])
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(geoms), npix))
+    return {'matrix':matrix, 'digests':digests, 'grid':grid, 'pixel_area':area}
+
+def save_index(index, path):
+    m = index['matrix']
+    g = index['grid']
+    np.savez(path, version=INDEX_VERSION, indptr=m.indptr, indices=m.indices, data=m.data,
+             digests=index['digests'], crs=g['crs'], transform=g['transform'], shape=g['shape'],
+             pixel_area=index['pixel_area'])
+
+def load_index(path):
+    # Returns None when the file is missing or written by another version
+    if not(os.path.isfile(path)):
+        return None
+    with np.load(path) as f:
+        if int(f['version']) != INDEX_VERSION:
+            return None
+        grid = {'crs':str(f['crs']), 'transform':f['transform'], 'shape':f['shape']}
+        npix = int(grid['shape'][0])*int(grid['shape'][1])
+        matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                   shape=(len(f['digests']), npix))
+        return {'matrix':matrix, 'digests':f['digests'], 'grid':grid, 'pixel_area':f['pixel_area']}
+
+def zone_index(geom_path, geoms, raster_path, index=None, workers=1, layer=None):
+    # Zone-to-pixel index of the geometries stored in geom_path (layer) on the grid
+    # of raster_path. The index kept on disk (or the one given as argument)
+    # is used as long as the grid and the geometries are unchanged.
+    # Otherwise it is rebuilt, reusing the rows of the unchanged zones,
+    # and saved again.
+
+    with rasterio.open(raster_path, 'r') as src:
+        grid = raster_grid(src)
+    digests = geometry_digests(geoms)
+    path = index_path(geom_path, layer)
+
+    if index is None:
+        index = load_index(path)
+    if (index is not None) and not(same_grid(index['grid'], grid)):
+        print('Zone index: raster grid has changed')
+        index = None
+    if (index is not None) and np.array_equal(index['digests'], digests):
+        return index
+
+    index = build_index(geoms, grid, digests=digests, reuse=index, workers=workers)
+    print('Saving zone index', path)
+    save_index(index, path)
+    return index
+
+def index_rows(index, rows):
+    # Subset of the index for the selected zones (positional)
+    return {'matrix':index['matrix'][rows], 'digests':index['digests'][rows],
+            'grid':index['grid'], 'pixel_area':index['pixel_area']}
+
+def stack_indexes(indexes):
+    # One index with the zones of several indexes on the same grid, one
+    # after the other. Zones of different layers (e.g. radii, clipped and
+    # unclipped buffers) then share a single read of every pixel and are
+    # reduced by one sparse product.
+    grid = indexes[0]['grid']
+    for index in indexes[1:]:
+        if not(same_grid(index['grid'], grid)):
+            raise ValueError('Zone indexes are built on different grids')
+    return {'matrix':sparse.vstack([index['matrix'] for index in indexes], format='csr'),
+            'digests':np.concatenate([index['digests'] for index in indexes]),
+            'grid':grid, 'pixel_area':indexes[0]['pixel_area']}
+
+def index_sums(index, raster_path, band=1, nodata=None, streaming=False, density=False,
+               max_window=MAX_WINDOW):
+    # Count of valid pixels and sum of the pixel values of every zone,
+    # weighted by the covered fraction of the pixels (see zone_weights),
+    # computed as sparse matrix products over a single read of the
+    # window spanned by the indexed pixels. With streaming, or when the
+    # window is larger than max_window (bytes), the window is read block
+    # by block and the products are accumulated block by block.
+    # density: the pixel values are densities (per km2), the sum is weighted
+    # by the covered area of the pixels (fraction x pixel_area) instead.
+
+    m = index['matrix']
+    n = m.shape[0]
+    count = np.zeros(n)
+    total = np.zeros(n)
+    if m.nnz < 1:
+        return count, total
+
+    width = int(index['grid']['shape'][1])
+    r, c = np.divmod(m.indices, width)
+    row0, col0 = r.min(), c.min()
+    h, w = r.max() - row0 + 1, c.max() - col0 + 1
+    # Weights in float64, so that the products over the pixel values
+    # (read in their own dtype) are accumulated in float64.
+    frac = m.data.astype(float)
+    area = frac*index['pixel_area'][r] if density else frac
+
+    with rasterio.open(raster_path, 'r') as src:
+        if nodata is None:
+            nodata = src.nodata
+        win = Window(col0, row0, w, h)
+        size = h*w*np.dtype(src.dtypes[band-1]).itemsize
+        if not(streaming) and (size <= max_window):
+            local = (r - row0)*w + (c - col0)
+            values = src.read(band, window=win).ravel()
+            valid = valid_mask(values, nodata)
+            values[~valid] = 0
+            count = sparse.csr_matrix((frac, local, m.indptr), shape=(n, h*w)) @ valid
+            total = sparse.csr_matrix((area, local, m.indptr), shape=(n, h*w)) @ values
+            return count, total
+
+        # Reading blocks of the raster (see block_shape) in the native dtype
+        # into a reused buffer. The entries of the index are grouped by
+        # block, so only the blocks holding indexed pixels are read and the
+        # memory does not depend on the size of the window.
+        bh, bw = block_shape(src)
+        zone = np.repeat(np.arange(n), np.diff(m.indptr))
+        block = (r//bh)*((width + bw - 1)//bw) + c//bw
+        order = np.argsort(block, kind='stable')
+        starts = np.flatnonzero(np.diff(block[order], prepend=-1))
+        ends = np.append(starts[1:], len(order))
+        buf = np.empty(bh*bw, dtype=src.dtypes[band-1])
+        for a, b in zip(starts, ends):
+            e = order[a:b]
+            br, bc = (r[e[0]]//bh)*bh, (c[e[0]]//bw)*bw
+            r0, c0 = max(br, row0), max(bc, col0)
+            r1, c1 = min(br + bh, row0 + h), min(bc + bw, col0 + w)
+            values = buf[:(r1-r0)*(c1-c0)].reshape(r1-r0, c1-c0)
+            src.read(band, window=Window(c0, r0, c1-c0, r1-r0), out=values)
+            v = values[r[e] - r0, c[e] - c0]
+            valid = valid_mask(v, nodata)
+            v = np.where(valid, v, 0)
+            # The entries of a block are sorted by zone
+            zu, first = np.unique(zone[e], return_index=True)
+            count[zu] += np.add.reduceat(frac[e]*valid, first)
+            total[zu] += np.add.reduceat(area[e]*v, first)
+    return count, total
@@ -5,7 +5,9 @@ import pandas as pd
 import geopandas as gpd
 import rasterio
 import matplotlib.pyplot as plt
-from rasterstats import zonal_stats
+
+import get_buffer
+import zonal_engine
 
 def usage():
     print('Usage: python zonal_statistics.py [OPTIONS]')
@@ -27,6 +29,26 @@ def usage():
     print('                             mean, std.')
     print('-p, --plot                   Visualize the output, e.g. the features with the')
     print('                             first statistics as the color scaler.')
+    print('--stream                     Read the raster block by block to keep the memory')
+    print('                             use bounded. Only count, sum, mean, std, min,')
+    print('                             max, and range are available.')
+    print('-w, --workers                Number of worker processes. The zones are split')
+    print('                             into spatial chunks processed in parallel.')
+    print('                             Default: 1')
+    print('--radial                     For points, compute the statistics of all radii')
+    print('                             from one read around each point: the pixels')
+    print('                             within the largest radius are sorted by their')
+    print('                             geodesic distance to the point. A pixel is in the')
+    print('                             buffer if its centre is within the radius.')
+    print('                             With --stream, the points are visited along a')
+    print('                             Hilbert curve and read through a cache of raster')
+    print('                             blocks.')
+    print('--block-cache                Size (MB) of the cache of raster blocks of the')
+    print('                             radial mode with --stream. Default: 256')
+    print('--sample                     For points, the values of the raster at the points')
+    print('                             instead of buffer statistics: nearest or bilinear')
+    print('                             (e.g. --sample bilinear). All points are sampled')
+    print('                             together, every raster block is read once.')
     print('-h, --help                   Show this message and exit.')
     print('')
     print('Example: python zonal_statistics.py -f tmp.tif -z tmp.shp -r 1000,2000 -s sum')
@@ -42,6 +64,11 @@ def main(argv=None):
     band_indexes = [1]
     output_file = 'output.csv'
     do_plot = False
+    streaming = False
+    workers = 1
+    radial = False
+    sample = None
+    cache_size = 256
     stats = ['min','max','mean','std']
 
     i = 1
@@ -64,15 +91,15 @@ def main(argv=None):
 
             if (zones_file[-4:] == '.shp'):
                 gdf = gpd.read_file(zones_file)
-                crs2 = gdf._crs.srs.upper()
+                crs2 = gdf.crs.srs.upper()
                 if (crs2 != crs):
                     print('Transforming CRS of the zones: from %s to %s'%(crs2, crs))
                     gdf = gdf.to_crs(crs)
-                if (gdf.geometry[0].geometryType() == 'Point'):
+                if (gdf.geometry[0].geom_type == 'Point'):
                     create_buffer = True
                 else:
                     create_buffer = False
-                    gdf.to_file('tmp_zones.shp', index=False)
+                    zones = gdf
 
             elif (zones_file[-4:] == '.csv'):
                 gdf = pd.read_csv(zones_file)
@@ -83,8 +110,7 @@ def main(argv=None):
                     print('lat column is not found in %s'%zones_file)
                     sys.exit(1)
                     
-                pts = gpd.GeoSeries([Point(x,y) for x,y in zip(gdf.lon.values,gdf.lat.values)])
-                gdf['geometry'] = pts
+                gdf = gpd.GeoDataFrame(gdf, geometry=gpd.points_from_xy(gdf.lon, gdf.lat), crs=4326)
                 create_buffer = True
                 
         elif (argv[i] in ['-r', '--rad']):
@@ -95,16 +121,18 @@ def main(argv=None):
             #if (crs[5:] in ['4326']):
             #    buffer *= 8.983346e-6 #converting metre to degrees
             if (create_buffer):
-                gdf2 = gpd.GeoDataFrame()
+                pts = gdf.to_crs(4326).geometry
                 #if there are multiple buffer radii, than additional rows
-                #will be created
-                for j,b in enumerate(buffer):
-                    df = gdf.copy()
-                    df['geometry'] = gdf.to_crs(3857).buffer(b)
-                    df['buffer'] = b
-                    df['buff_idx'] = j
-                    gdf2 = pd.concat([gdf2,df], ignore_index=False)
-                gdf2.to_crs(crs).to_file('tmp_zones.shp', index=False)
+                #will be created. The circles of all radii are computed
+                #in one call.
+                n = len(gdf)
+                circles, area = get_buffer.geodesic_circles(np.tile(pts.x, len(buffer)), np.tile(pts.y, len(buffer)),
+                                                            np.repeat(buffer, n))
+                gdf2 = pd.concat([gdf.drop(columns=['geometry'])]*len(buffer), ignore_index=False)
+                gdf2['area'] = area
+                gdf2['buffer'] = np.repeat(buffer, n)
+                gdf2['buff_idx'] = np.repeat(np.arange(len(buffer)), n)
+                zones = gpd.GeoDataFrame(gdf2, geometry=circles, crs=4326).to_crs(crs)
                     
         elif (argv[i] in ['-b', '--band']):
             band_indexes = argv[i+1].replace(' ','').split(',')
@@ -117,6 +145,24 @@ def main(argv=None):
             
         elif (argv[i] in ['-p', '--plot']):
             do_plot = True
+
+        elif (argv[i] in ['--stream']):
+            streaming = True
+
+        elif (argv[i] in ['--radial']):
+            radial = True
+
+        elif (argv[i] in ['--block-cache']):
+            cache_size = float(argv[i+1])
+
+        elif (argv[i] in ['--sample']):
+            sample = argv[i+1]
+            if not(sample in ['nearest', 'bilinear']):
+                print('Sampling method should be nearest or bilinear')
+                sys.exit(1)
+
+        elif (argv[i] in ['-w', '--workers']):
+            workers = int(argv[i+1])
         
         elif (argv[i] in ['-s', '--stats']):
             stats = argv[i+1].replace(' ','').split(',')
@@ -129,7 +175,14 @@ def main(argv=None):
             
         i += 1
         
-    if create_buffer:
+    if (sample is not None) and not(create_buffer):
+        print('Sampling is only available for points')
+        sys.exit(1)
+    if sample is not None:
+        remark = '%d points, %s sampling'%(len(gdf), sample)
+        zones = gdf.to_crs(crs)
+        stats = ['value']
+    elif create_buffer:
         remark = '%d points, %d buffer(s)'%(len(gdf), len(buffer))
     else:
         remark = '%d polygons'%(len(gdf))
@@ -142,10 +195,38 @@ def main(argv=None):
     print('output:', output_files)
     print('stats:', stats)
 
+    # The zones are rasterized once and all bands are reduced
+    # from a single read of the raster window (or block by block).
+    zones = zones.reset_index(drop=True)
+    if sample is not None:
+        values = zonal_engine.sample_points(zones.geometry.x.values, zones.geometry.y.values, raster_file,
+                                            band_indexes=band_indexes, method=sample, nodata=-99)
+        results = {b:pd.DataFrame({'value':v}) for b,v in values.items()}
+    elif radial and not(create_buffer):
+        print('Radial mode is only available for points')
+        sys.exit(1)
+    elif radial:
+        # The rows of the zones follow the radii, then the points
+        if workers > 1:
+            print('--workers is not used in radial mode')
+        pts = gdf.to_crs(4326).geometry
+        results = zonal_engine.radial_stats(pts.x.values, pts.y.values, buffer, raster_file,
+                                            band_indexes=band_indexes, stats=stats, nodata=-99,
+                                            streaming=streaming, cache_size=cache_size)
+    elif workers > 1:
+        results = zonal_engine.parallel_stats(zones.geometry.values, raster_file,
+                                              band_indexes=band_indexes, stats=stats, nodata=-99,
+                                              workers=workers, streaming=streaming)
+    elif streaming:
+        results = zonal_engine.stream_stats(zones.geometry.values, raster_file,
+                                            band_indexes=band_indexes, stats=stats, nodata=-99)
+    else:
+        results = zonal_engine.label_stats(zones.geometry.values, raster_file,
+                                           band_indexes=band_indexes, stats=stats, nodata=-99)
+
     for band_num in band_indexes:
-        stat = zonal_stats('tmp_zones.shp', raster_file, nodata=-99, stats=stats, band_num=int(band_num))
-        stat = pd.DataFrame(stat)
-        gdf = gpd.read_file('tmp_zones.shp')
+        stat = results[int(band_num)]
+        gdf = zones.copy()
         for s in stat.columns:
             gdf[s] = stat[s].values
         if (output_file[-4:] == '.shp'):
@@ -164,7 +245,5 @@ def main(argv=None):
             
         print('Done with band', band_num)
     
-    os.remove('tmp_zones.shp')
-    
 if __name__ == '__main__':
     sys.exit(main())